@@ -0,0 +1,463 @@
+import math
+from dataclasses import dataclass
+import torch
+import torch.nn.functional as F
+from .config import CONFIG
+
+# working memory per tile pixel while sampling a layer, float32:
+# grid (2), sampled rgb + mask (4), coordinates, coverage and scratch (6)
+TILE_BYTES_PER_PIXEL = 12 * 4
+# memory per canvas pixel of one rendered layer: rgb image + mask, float32
+LAYER_BYTES_PER_PIXEL = 4 * 4
+# working memory per tile pixel and layer of the visible_masks and composite passes, float32: alpha, its
+# complement, the flipped cumulative product and its flip back, the run weights and the rgb the einsum copies (3)
+COMPOSITE_BYTES_PER_PIXEL = 8 * 4
+# memory per canvas pixel of their outputs: one visible mask per layer, and the rgb composite once
+VISIBLE_BYTES_PER_PIXEL = 1 * 4
+COMPOSITE_OUT_BYTES_PER_PIXEL = 3 * 4
+# never tile thinner than this, the per-tile overhead would dominate
+MIN_TILE_ROWS = 16
+
+
+class LayerPlacement:
+    """
+    Where a layer lands on the canvas, from its fabric transform and bounding box.
+    Follows fabric: the image is scaled, flipped and rotated about its center, and the bounding rect of the
+    result has its top-left corner at the bbox position (minus the editor padding).
+    canvas_scale renders the placement on a canvas scaled by that factor (draft renders).
+    """
+
+    def __init__(self, transform, bbox, padding, width, height, canvas_scale=1.0):
+        self.width = width
+        self.height = height
+        self.scale_x = abs(float(transform.get("scaleX", 1.0))) * canvas_scale
+        self.scale_y = abs(float(transform.get("scaleY", 1.0))) * canvas_scale
+        self.flip_x = bool(transform.get("flipX", False))
+        self.flip_y = bool(transform.get("flipY", False))
+        self.angle = float(transform.get("angle", 0) or 0)
+
+        # size of the scaled image and of its rotated bounding rect, in canvas pixels
+        self.scaled_width = width * self.scale_x
+        self.scaled_height = height * self.scale_y
+        radians = math.radians(self.angle)
+        self.cos = math.cos(radians)
+        self.sin = math.sin(radians)
+        self.bounds_width = abs(self.scaled_width * self.cos) + abs(self.scaled_height * self.sin)
+        self.bounds_height = abs(self.scaled_width * self.sin) + abs(self.scaled_height * self.cos)
+
+        self.left = (float(bbox.get("left", padding)) - padding) * canvas_scale
+        self.top = (float(bbox.get("top", padding)) - padding) * canvas_scale
+        self.center_x = self.left + self.bounds_width / 2
+        self.center_y = self.top + self.bounds_height / 2
+
+    def footprint(self, canvas_width, canvas_height):
+        """Pixel rect (x0, y0, x1, y1) of the canvas the layer can touch, empty when it is off canvas."""
+        if self.scaled_width <= 0 or self.scaled_height <= 0:
+            return 0, 0, 0, 0
+        x0 = max(0, math.floor(self.left))
+        y0 = max(0, math.floor(self.top))
+        x1 = min(canvas_width, math.ceil(self.left + self.bounds_width))
+        y1 = min(canvas_height, math.ceil(self.top + self.bounds_height))
+        return x0, y0, max(x0, x1), max(y0, y1)
+
+    def grid(self, x0, x1, y0, y1):
+        """
+        Sampling grid for the canvas rect, in grid_sample coordinates (-1..1 over the source image).
+        Also returns the antialiased coverage of the rect by the layer.
+        """
+        xs = torch.arange(x0, x1, dtype=torch.float32) + (0.5 - self.center_x)
+        ys = torch.arange(y0, y1, dtype=torch.float32) + (0.5 - self.center_y)
+        # undo the rotation, distances from the layer center along its own axes
+        u = xs[None, :] * self.cos + ys[:, None] * self.sin
+        v = ys[:, None] * self.cos - xs[None, :] * self.sin
+
+        # distance to the layer edge in canvas pixels, gives a one pixel wide antialiased border
+        coverage = (self.scaled_width / 2 + 0.5 - u.abs()).clamp_(0, 1)
+        coverage.mul_((self.scaled_height / 2 + 0.5 - v.abs()).clamp_(0, 1))
+
+        gx = u.mul_((-2 if self.flip_x else 2) / self.scaled_width)
+        gy = v.mul_((-2 if self.flip_y else 2) / self.scaled_height)
+        return torch.stack((gx, gy), dim=-1).unsqueeze(0), coverage
+
+
+def constant_mask(width, height, value=1.0):
+    """
+    [1, height, width] mask of one value (1 = nothing visible by default), an expand view of a single element
+    so a canvas-sized mask for an empty slot costs no memory. Built per call, never shared, but still a view
+    that can't be written in place: readers copy it (expand_mask(...).contiguous()) before handing it on.
+    """
+    return torch.full((1, 1, 1), float(value)).expand(1, height, width)
+
+
+@dataclass(frozen=True)
+class CompositorTransforms:
+    """
+    Layer placements of a composition, parsed once from fabricData so transforms nodes don't re-parse it.
+    One tuple per field, indexed by layer slot, padding already removed. Slots without a layer have
+    present False and zeros. The bbox fields keep the editor's naming (its xwidth/xheight).
+    Also carries what is needed to redo the placement exactly (scale, flip, visibility, opacity and the
+    stacking order, bottom to top), see placement.
+    """
+    padding: float = 0
+    canvas_width: int = 0
+    canvas_height: int = 0
+    present: tuple = ()
+    x: tuple = ()
+    y: tuple = ()
+    width: tuple = ()
+    height: tuple = ()
+    angle: tuple = ()
+    bbox_x: tuple = ()
+    bbox_y: tuple = ()
+    bbox_width: tuple = ()
+    bbox_height: tuple = ()
+    scale_x: tuple = ()
+    scale_y: tuple = ()
+    flip_x: tuple = ()
+    flip_y: tuple = ()
+    visible: tuple = ()
+    opacity: tuple = ()
+    blend: tuple = ()
+    order: tuple = ()
+
+    FIELDS = ("x", "y", "width", "height", "angle", "bbox_x", "bbox_y", "bbox_width", "bbox_height")
+
+    @classmethod
+    def from_fabric(cls, data):
+        """Build from the parsed fabricData dict of the V4 editor."""
+        padding = data.get("padding", 0) or 0
+        transforms = data.get("transforms") or []
+        bboxes = data.get("bboxes") or []
+        columns = {field: [] for field in cls.FIELDS + ("scale_x", "scale_y", "flip_x", "flip_y", "visible", "opacity", "blend")}
+        present = []
+        for index, transform in enumerate(transforms):
+            bbox = (bboxes[index] if index < len(bboxes) else None) or {}
+            present.append(bool(transform))
+            transform = transform or {}
+            columns["x"].append(transform.get("left", padding) - padding)
+            columns["y"].append(transform.get("top", padding) - padding)
+            columns["width"].append(transform.get("xwidth", 0) * transform.get("scaleX", 1))
+            columns["height"].append(transform.get("xheight", 0) * transform.get("scaleY", 1))
+            columns["angle"].append(transform.get("angle", 0) or 0)
+            columns["bbox_x"].append(bbox.get("left", padding) - padding)
+            columns["bbox_y"].append(bbox.get("top", padding) - padding)
+            columns["bbox_width"].append(bbox.get("xwidth", 0))
+            columns["bbox_height"].append(bbox.get("xheight", 0))
+            columns["scale_x"].append(float(transform.get("scaleX", 1.0)))
+            columns["scale_y"].append(float(transform.get("scaleY", 1.0)))
+            columns["flip_x"].append(bool(transform.get("flipX", False)))
+            columns["flip_y"].append(bool(transform.get("flipY", False)))
+            # Fabric puts `visible` on each object, old data without it is visible
+            columns["visible"].append(bool(transform) and bool(transform.get("visible", True)))
+            columns["opacity"].append(float(transform.get("opacity", 1.0)))
+            columns["blend"].append(transform.get("globalCompositeOperation") or "source-over")
+        order = stacking_order(range(len(transforms)), data.get("imagePositions"), data.get("lockedLayerIndex"))
+        return cls(padding, int(data.get("width", 0) or 0), int(data.get("height", 0) or 0), tuple(present),
+                   order=tuple(order), **{field: tuple(values) for field, values in columns.items()})
+
+    def __len__(self):
+        return len(self.present)
+
+    def layer(self, index):
+        """The 9 values of one layer slot (0-based), in FIELDS order."""
+        return tuple(getattr(self, field)[index] for field in self.FIELDS)
+
+    def placement(self, index, width, height, canvas_scale=1.0):
+        """LayerPlacement of slot index for a layer image of width x height, same as Compositor4 renders it."""
+        transform = {
+            "scaleX": self.scale_x[index], "scaleY": self.scale_y[index],
+            "flipX": self.flip_x[index], "flipY": self.flip_y[index], "angle": self.angle[index],
+        }
+        bbox = {"left": self.bbox_x[index], "top": self.bbox_y[index]}
+        return LayerPlacement(transform, bbox, 0, width, height, canvas_scale)
+
+
+def plan_render(canvas_width, canvas_height, layer_count, budget_mb=None, composite=False):
+    """
+    Estimate the peak memory of rendering layer_count layers on the canvas, and pick a tile height
+    that keeps it under the budget (BEYOND_NODES_RENDER_BUDGET_MB). With composite, the visible_masks and
+    composite passes that follow on the same tiles are counted too, outputs and working memory.
+    Returns (estimated bytes, tile rows), tile rows is None when the whole canvas fits in one pass.
+    An estimate over the budget means the outputs alone don't fit it, even with the thinnest tiles.
+    """
+    budget = (budget_mb or CONFIG["render_budget_mb"]) * 1024 * 1024
+    pixels = canvas_width * canvas_height
+    outputs = pixels * layer_count * LAYER_BYTES_PER_PIXEL
+    tile_bytes = TILE_BYTES_PER_PIXEL
+    if composite:
+        outputs += pixels * (layer_count * VISIBLE_BYTES_PER_PIXEL + COMPOSITE_OUT_BYTES_PER_PIXEL)
+        tile_bytes = max(tile_bytes, layer_count * COMPOSITE_BYTES_PER_PIXEL)
+    single_pass = outputs + pixels * tile_bytes
+    if single_pass <= budget:
+        return single_pass, None
+
+    rows = int((budget - outputs) // (canvas_width * tile_bytes))
+    rows = min(canvas_height, max(MIN_TILE_ROWS, rows))
+    return outputs + rows * canvas_width * tile_bytes, rows
+
+
+def row_tiles(height, tile_rows=None):
+    """(start, stop) of the row bands of a tiled pass, one band covering everything when tile_rows is None."""
+    step = tile_rows or max(height, 1)
+    return [(start, min(start + step, height)) for start in range(0, height, step)]
+
+
+def shrink_source(source, placement, mode):
+    """
+    Pre-shrink a [N, C, h, w] source with an antialiased filter when the layer is drawn smaller than it,
+    so sampling it does not alias. Grid coordinates don't depend on the source size, the same grid samples
+    the result. Bilinear (draft) renders pre-shrink with the cheaper bilinear filter.
+    """
+    if mode == "nearest":
+        return source
+    height, width = source.shape[-2:]
+    # relative to the source, so maps of another resolution than the layer image shrink alike
+    target_height = max(1, round(height * placement.scaled_height / placement.height)) if placement.scale_y < 1 else height
+    target_width = max(1, round(width * placement.scaled_width / placement.width)) if placement.scale_x < 1 else width
+    if (target_height, target_width) == (height, width):
+        return source
+    resample = "bilinear" if mode == "bilinear" else "bicubic"
+    return F.interpolate(source, size=(target_height, target_width), mode=resample, antialias=True).clamp_(0, 1)
+
+
+def layer_alpha(mask, size, placement, mode):
+    """[1, 1, h, w] alpha of a layer from its [B, h, w] / [h, w] mask (first frame), at the layer image size."""
+    if mask is None:
+        return None
+    alpha = (mask[0] if mask.dim() == 3 else mask)[None, None].float()
+    if alpha.shape[-2:] != tuple(size):
+        alpha = F.interpolate(alpha, size=tuple(size), mode="bilinear")
+    return shrink_source(alpha, placement, mode)
+
+
+def sample_layer(source, alpha, placement, out_image, out_mask, mode="bicubic", tile_rows=None, composite=False):
+    """
+    Tile loop shared by render_layer and render_maps: sample the [N, C, h, w] source and its alpha with
+    one grid per tile, expanded over the N maps.
+    Written into out_image [N, H, W, C] (straight color, black outside the layer) and out_mask [H, W]
+    (1 - coverage * alpha), or with composite, blended over what out_image holds and multiplied into out_mask.
+    """
+    canvas_height, canvas_width = out_mask.shape
+    x0, y0, x1, y1 = placement.footprint(canvas_width, canvas_height)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    step = tile_rows or (y1 - y0)
+    for r0 in range(y0, y1, step):
+        r1 = min(r0 + step, y1)
+        grid, coverage = placement.grid(x0, x1, r0, r1)
+
+        color = F.grid_sample(source, grid.expand(source.shape[0], -1, -1, -1), mode=mode, padding_mode="border", align_corners=False)
+        if mode == "bicubic":
+            color.clamp_(0, 1)
+        color = color.movedim(1, -1)
+
+        if alpha is not None:
+            sampled = F.grid_sample(alpha, grid, mode="nearest" if mode == "nearest" else "bilinear", padding_mode="border", align_corners=False)[0, 0]
+        if composite:
+            if alpha is not None:
+                coverage.mul_(sampled)
+            out_image[:, r0:r1, x0:x1].lerp_(color, coverage.unsqueeze(-1))
+            out_mask[r0:r1, x0:x1].mul_(coverage.neg_().add_(1))
+        else:
+            # the antialiased edge lives in the mask, like any image + mask pair
+            out_image[:, r0:r1, x0:x1] = color.masked_fill_(coverage.eq(0).unsqueeze(-1), 0)
+            if alpha is not None:
+                coverage.mul_(sampled)
+            out_mask[r0:r1, x0:x1] = coverage.neg_().add_(1)
+        del color
+
+
+def render_layer(image, mask, placement, out_image, out_mask, mode="bicubic", tile_rows=None):
+    """
+    Sample one layer into its preallocated canvases, tile by tile.
+
+    image is [B, h, w, C] (first frame used), mask is [B, h, w] / [h, w] alpha or None.
+    out_image [H, W, 3] must start black and out_mask [H, W] at 1 (nothing visible): only the layer's
+    footprint is written, and working memory is bounded by tile_rows times the footprint width.
+    """
+    frame = image[0] if image.dim() == 4 else image
+    source = shrink_source(frame[..., :3].movedim(-1, 0).unsqueeze(0).float(), placement, mode)
+    alpha = layer_alpha(mask, frame.shape[:2], placement, mode)
+    sample_layer(source, alpha, placement, out_image.unsqueeze(0), out_mask, mode, tile_rows)
+
+
+def render_maps(maps, mask, image_size, placement, out_maps, out_mask, mode="bicubic", tile_rows=None):
+    """
+    Composite a layer's auxiliary maps (depth, normals, hints...) over out_maps with the exact placement of
+    the layer image: maps is [N, h, w, C], all N warped in one batched pass whatever their resolution.
+    image_size is the (h, w) of the layer image, the mask is resized to it like render_layer does.
+    out_maps [N, H, W, C] is blended in place, out_mask [H, W] multiplied by what the layer leaves uncovered.
+    """
+    source = shrink_source(maps.movedim(-1, 1).float(), placement, mode)
+    alpha = layer_alpha(mask, image_size, placement, mode)
+    sample_layer(source, alpha, placement, out_maps, out_mask, mode, tile_rows, composite=True)
+
+
+def subtract_masks(masks):
+    """
+    Remove from each layer mask what the layers above it cover, for a list of layer masks ordered bottom
+    to top (0 = visible, 1 = nothing, any batch shape as long as they broadcast).
+    One reverse cumulative pass over the stacked [L, ...] masks: a pixel of layer i is cleared (set to 1)
+    where any layer above i is visible (< 0.5). Returns the stacked result.
+    """
+    stacked = torch.stack(torch.broadcast_tensors(*masks)).float()
+    # covered[i] is true where layer i or one above it is visible
+    covered = (stacked < 0.5).flip(0).to(torch.uint8).cummax(0).values.flip(0)
+    stacked[:-1].masked_fill_(covered[1:].bool(), 1.0)
+    return stacked
+
+
+# bit weights of a packed mask byte, first pixel in the high bit like numpy.packbits
+PACK_WEIGHTS = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8)
+
+
+def compact_image(image):
+    """Float image in 0..1 to uint8, 4x smaller to keep around; expand_image turns it back."""
+    return image.mul(255).round_().to(torch.uint8)
+
+
+def compact_mask(mask):
+    """
+    Float mask to its compact form: bit-packed along the rows when it only holds 0 and 1
+    ({"bits": uint8 [..., ceil(W / 8)], "width": W}, 32x smaller), uint8 otherwise.
+    """
+    binary = mask == 1
+    if not torch.equal(binary, mask != 0):
+        return compact_image(mask)
+    width = mask.shape[-1]
+    pad = -width % 8
+    if pad:
+        binary = F.pad(binary, (0, pad))
+    bits = binary.unflatten(-1, (-1, 8)).to(torch.uint8).mul_(PACK_WEIGHTS).sum(-1, dtype=torch.uint8)
+    return {"bits": bits, "width": width}
+
+
+def expand_image(image):
+    """Layer image back to float32 for a consumer; float images and None pass through."""
+    if image is None or image.is_floating_point():
+        return image
+    return image.float().div_(255)
+
+
+def expand_mask(mask):
+    """Layer mask back to float32 for a consumer, from either compact form; float masks and None pass through."""
+    if isinstance(mask, dict):
+        bits = mask["bits"].unsqueeze(-1).bitwise_and(PACK_WEIGHTS).ne_(0)
+        return bits.flatten(-2)[..., :mask["width"]].float()
+    return expand_image(mask)
+
+
+def stacking_order(slots, positions=None, locked=None):
+    """
+    Layer slots sorted bottom to top like the editor stacks them: by their imagePositions entry
+    (slot number when missing), with the locked background layer always at the bottom.
+    """
+    def key(idx):
+        if idx == locked:
+            return (0, 0, idx)
+        position = positions[idx] if isinstance(positions, list) and idx < len(positions) else None
+        return (1, position if isinstance(position, (int, float)) else idx, idx)
+    return sorted(slots, key=key)
+
+
+def visible_coverage(masks, opacity=None, tile_rows=None):
+    """
+    What is actually visible of each layer once the layers above are drawn over it, in one front-to-back pass.
+    masks is [L, H, ...] ordered bottom to top (0 = layer shows, 1 = nothing, soft values are partial alpha),
+    opacity an optional [L] of layer opacities. Returns [L, H, ...] masks in the same convention, computed
+    over bands of tile_rows rows (see plan_render) so the temporaries stay the size of one band.
+    """
+    out = torch.empty(masks.shape, dtype=torch.float32)
+    scale = None if opacity is None else torch.as_tensor(opacity, dtype=torch.float32).view(-1, *[1] * (masks.dim() - 1))
+    for start, stop in row_tiles(masks.shape[1], tile_rows):
+        alpha = 1 - masks[:, start:stop].float()
+        if scale is not None:
+            alpha.mul_(scale)
+        # transmitted[i] is how much of the layers below i shows through layers i and above
+        transmitted = (1 - alpha).flip(0).cumprod(0).flip(0)
+        alpha[:-1].mul_(transmitted[1:])
+        out[:, start:stop] = alpha.neg_().add_(1)
+    return out
+
+
+def _overlay(backdrop, source):
+    return torch.where(backdrop <= 0.5, 2 * backdrop * source, 1 - 2 * (1 - backdrop) * (1 - source))
+
+
+def _soft_light(backdrop, source):
+    darkened = backdrop - (1 - 2 * source) * backdrop * (1 - backdrop)
+    curve = torch.where(backdrop <= 0.25, ((16 * backdrop - 12) * backdrop + 4) * backdrop, backdrop.sqrt())
+    return torch.where(source <= 0.5, darkened, backdrop + (2 * source - 1) * (curve - backdrop))
+
+
+# separable blend modes by their canvas globalCompositeOperation name, B(backdrop, source) from the W3C
+# compositing spec; "source-over" (normal) is handled apart, it is the one that vectorizes over layers
+BLEND_MODES = {
+    "multiply": lambda b, s: b * s,
+    "screen": lambda b, s: b + s - b * s,
+    "overlay": _overlay,
+    "darken": torch.minimum,
+    "lighten": torch.maximum,
+    "color-dodge": lambda b, s: torch.where(b == 0, 0.0, (b / (1 - s).clamp_min(1e-6)).clamp_max(1)),
+    "color-burn": lambda b, s: torch.where(b == 1, 1.0, 1 - ((1 - b) / s.clamp_min(1e-6)).clamp_max(1)),
+    "hard-light": lambda b, s: _overlay(s, b),
+    "soft-light": _soft_light,
+    "difference": lambda b, s: (b - s).abs(),
+    "exclusion": lambda b, s: b + s - 2 * b * s,
+}
+
+
+def parse_color(value, default=(0.0, 0.0, 0.0)):
+    """RGB floats of a css '#rrggbb' or 'rgb(a)(r, g, b, ...)' color, alpha ignored."""
+    try:
+        value = str(value).strip()
+        if value.startswith("#") and len(value) in (4, 7):
+            digits = value[1:] if len(value) == 7 else "".join(c * 2 for c in value[1:])
+            return tuple(int(digits[i:i + 2], 16) / 255 for i in (0, 2, 4))
+        if value.startswith("rgb"):
+            parts = value[value.index("(") + 1:value.index(")")].split(",")
+            return tuple(float(part) / 255 for part in parts[:3])
+    except ValueError:
+        pass
+    return default
+
+
+def composite_layers(images, masks, blend_modes=None, opacity=None, background=(0.0, 0.0, 0.0), tile_rows=None):
+    """
+    Composite a layer stack over an opaque background: images [L, H, W, 3] (straight color) and masks
+    [L, H, W] (0 = layer shows) ordered bottom to top, with per-layer canvas blend modes and opacity.
+    Runs of normal ("source-over") layers are folded in one vectorized pass: each layer weighs its alpha
+    times what the layers above let through (a reverse cumulative product), so a stack of normal layers
+    costs one pass whatever its depth. Other modes depend on the backdrop below them and are applied
+    in place as they come, one fused lerp each. Every pixel is independent, so it runs over bands of
+    tile_rows rows (see plan_render) into the output. Returns [1, H, W, 3].
+    """
+    count, height, width = masks.shape
+    blend_modes = blend_modes or ["source-over"] * count
+    scale = None if opacity is None else torch.as_tensor(opacity, dtype=torch.float32).view(-1, 1, 1)
+    result = torch.tensor(background, dtype=torch.float32).view(1, 1, 3).repeat(height, width, 1)
+
+    for top, bottom in row_tiles(height, tile_rows):
+        out = result[top:bottom]
+        band = images[:, top:bottom]
+        alpha = 1 - masks[:, top:bottom].float()
+        if scale is not None:
+            alpha.mul_(scale)
+        start = 0
+        while start < count:
+            if blend_modes[start] in BLEND_MODES:
+                blended = BLEND_MODES[blend_modes[start]](out, band[start].float())
+                out.lerp_(blended, alpha[start].unsqueeze(-1))
+                start += 1
+                continue
+            end = start
+            while end < count and blend_modes[end] not in BLEND_MODES:
+                end += 1
+            run = alpha[start:end]
+            # transmitted[i] is how much of what is below layer i shows through layers i and above (in the run)
+            transmitted = (1 - run).flip(0).cumprod(0).flip(0)
+            run[:-1].mul_(transmitted[1:])
+            out.mul_(transmitted[0].unsqueeze(-1)).add_(torch.einsum("lhw,lhwc->hwc", run, band[start:end].float()))
+            start = end
+    return result.clamp_(0, 1).unsqueeze(0)
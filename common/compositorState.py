@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from .config import CONFIG
+
+
+class SnapshotWaiters:
+    """
+    Futures a compositor suspends on while the editor builds its snapshot.
+    Keyed by (scope, node_id) like CompositorStateStore, resolved from the /compositor/done route
+    with the snapshot the editor uploaded.
+    The route runs on the server loop and the node on the prompt worker, so plain thread-safe futures are used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    def wait(self, key) -> Future:
+        """Register a waiter for key, replacing (and cancelling) any stale one left behind."""
+        future = Future()
+        with self._lock:
+            stale = self._waiters.get(key)
+            self._waiters[key] = future
+        if stale is not None:
+            stale.cancel()
+        return future
+
+    def resolve(self, key, snapshot) -> bool:
+        """Hand the snapshot to the waiter for key, returns False when nobody is waiting."""
+        with self._lock:
+            future = self._waiters.pop(key, None)
+        if future is None or future.done():
+            return False
+        future.set_result(snapshot)
+        return True
+
+    def discard(self, key, future):
+        """Forget the waiter for key if it is still future (timed out or interrupted)."""
+        with self._lock:
+            if self._waiters.get(key) is future:
+                del self._waiters[key]
+        future.cancel()
+
+    def waiting(self, key) -> bool:
+        with self._lock:
+            return key in self._waiters
+
+    def __len__(self):
+        with self._lock:
+            return len(self._waiters)
+
+
+snapshotWaiters = SnapshotWaiters()
+
+
+class CompositorStateStore:
+    """
+    Per-node compositor state shared by every prompt on the server.
+    Keys are (scope, node_id) where scope identifies the workflow (or client), so node "12" of one
+    user's workflow never overwrites node "12" of another's. Each entry is a small dict of fields.
+    Bounded by entry count (least recently used goes first) and idle time, guarded by a lock.
+    """
+
+    def __init__(self, max_entries=256, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (last access, fields)
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _expire(self, now):
+        # entries are kept in access order, so the stale ones are at the front
+        while self._entries:
+            key, (touched, _) = next(iter(self._entries.items()))
+            if now - touched <= self.ttl:
+                break
+            del self._entries[key]
+            self._expirations += 1
+
+    def _touch(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            fields = {}
+        else:
+            self._hits += 1
+            fields = entry[1]
+            self._entries.move_to_end(key)
+        self._entries[key] = (now, fields)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+        return fields
+
+    def get(self, key, field, default=None):
+        """Value of one field of the entry for key."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return default
+            self._hits += 1
+            self._entries.move_to_end(key)
+            self._entries[key] = (now, entry[1])
+            return entry[1].get(field, default)
+
+    def exchange(self, key, field, value, default=None):
+        """Set one field of the entry for key and return its previous value, in one step."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            fields = self._touch(key, now)
+            previous = fields.get(field, default)
+            fields[field] = value
+            return previous
+
+    def forget(self, field, node_id=None):
+        """Drop a field from every entry (or from the entries of one node id)."""
+        with self._lock:
+            for key, (_, fields) in self._entries.items():
+                if node_id is None or key[-1] == node_id:
+                    fields.pop(field, None)
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+
+compositorState = CompositorStateStore(CONFIG["compositor_state_entries"], CONFIG["compositor_state_ttl"])
@@ -3,5 +3,15 @@ import logging
 
 CONFIG = {
     "loglevel": int(os.environ.get("BEYOND_NODES_LOGLEVEL", logging.INFO)),
-    "indent": int(os.environ.get("BEYOND_NODES_INDENT", 2))
+    "indent": int(os.environ.get("BEYOND_NODES_INDENT", 2)),
+    # compositor per-node state: max entries kept (LRU) and seconds an idle entry survives
+    "compositor_state_entries": int(os.environ.get("BEYOND_NODES_COMPOSITOR_STATE_ENTRIES", 256)),
+    "compositor_state_ttl": int(os.environ.get("BEYOND_NODES_COMPOSITOR_STATE_TTL", 86400)),
+    # memory budget for rendering compositor layer outputs, above it layers are rendered in tiles
+    "render_budget_mb": int(os.environ.get("BEYOND_NODES_RENDER_BUDGET_MB", 4096)),
+    # on-disk cache of rendered compositor layers in MB, off (0) unless set, default folder is output/compositor/render_cache
+    "render_cache_mb": int(os.environ.get("BEYOND_NODES_RENDER_CACHE_MB", 0)),
+    "render_cache_dir": os.environ.get("BEYOND_NODES_RENDER_CACHE_DIR", ""),
+    # EditMask: temp files and decoded images kept (LRU), shared by the EditMask nodes
+    "edit_mask_cache_entries": int(os.environ.get("BEYOND_NODES_EDIT_MASK_CACHE_ENTRIES", 16)),
 }
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import torch
+from .config import CONFIG
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# bump when the rendering changes, so renders of an older version are not served
+RENDER_VERSION = 1
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+
+
+def renderKey(*parts):
+    """Fingerprint of everything a render depends on, parts must be JSON serializable."""
+    data = json.dumps([RENDER_VERSION, *parts], sort_keys=True, default=str).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@contextmanager
+def folderLock(path):
+    """Exclusive lock on a file, held across processes (workers sharing the cache folder) until the block ends."""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            # LK_LOCK retries for 10 seconds before raising, keep trying as long as another worker holds it
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class RenderCache:
+    """
+    Rendered compositor layers kept on disk across restarts, keyed by renderKey.
+    Each entry is a set of .npy arrays reloaded memory-mapped, plus a little metadata; a JSON index
+    holds sizes and last use so the least recently used entries go first when over max_bytes.
+    Several processes may share the folder: changes to the index are made under a file lock on a fresh
+    copy of it, and reads never write. Hits are remembered in memory and merged into the index on the next put.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = {}
+        self._index_stamp = None
+        self._used = {}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _read_index(self):
+        """The index as on disk, parsed again only when the file changed (it is always replaced whole)."""
+        path = os.path.join(self.folder, INDEX_FILE)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._index, self._index_stamp = {}, None
+            return self._index
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp != self._index_stamp:
+            try:
+                with open(path) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {}
+            self._index_stamp = stamp
+        return self._index
+
+    def _save_index(self, index):
+        # write then rename, a crash never leaves a truncated index behind
+        path = os.path.join(self.folder, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(path + ".tmp", path)
+
+    def _path(self, key, name):
+        return os.path.join(self.folder, f"{key}-{name}.npy")
+
+    def _remove_files(self, key, names):
+        for name in names:
+            for path in (self._path(key, name), self._path(key, name) + ".tmp"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _drop(self, index, key):
+        entry = index.pop(key, None)
+        self._remove_files(key, (entry or {}).get("arrays", []))
+        self._used.pop(key, None)
+
+    def _collect_orphans(self, index):
+        """Remove files no index entry accounts for, left by a crash or a failed write, and entries missing files."""
+        for key in [key for key, entry in index.items()
+                    if not all(os.path.exists(self._path(key, name)) for name in entry["arrays"])]:
+            self._drop(index, key)
+        known = {os.path.basename(self._path(key, name)) for key, entry in index.items() for name in entry["arrays"]}
+        for file in os.listdir(self.folder):
+            if file.endswith((".npy", ".npy.tmp")) and file not in known:
+                try:
+                    os.remove(os.path.join(self.folder, file))
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """(arrays, meta) of the entry, arrays as tensors over memory-mapped files, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._read_index().get(key)
+            if entry is None:
+                return None
+            try:
+                # copy-on-write maps: pages are read lazily and the files are never written through
+                arrays = {name: torch.from_numpy(np.load(self._path(key, name), mmap_mode="c")) for name in entry["arrays"]}
+            except (OSError, ValueError):
+                # a worker may have evicted it since the index was read, the next put cleans up what is left
+                print(f"[RenderCache] Entry {key} is unreadable, skipping it")
+                return None
+            self._used[key] = time.time()
+            return arrays, entry["meta"]
+
+    def put(self, key, arrays, meta):
+        """Store tensors (name -> tensor) and JSON metadata under key, then evict down to max_bytes."""
+        if not self.enabled:
+            return
+        size = sum(tensor.numel() * tensor.element_size() for tensor in arrays.values())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                with folderLock(os.path.join(self.folder, LOCK_FILE)):
+                    # a fresh copy: other workers may have changed the index since this one last read it
+                    index = {k: dict(entry) for k, entry in self._read_index().items()}
+                    try:
+                        for name, tensor in arrays.items():
+                            path = self._path(key, name)
+                            with open(path + ".tmp", "wb") as f:
+                                np.save(f, tensor.contiguous().numpy())
+                            os.replace(path + ".tmp", path)
+                    except (OSError, ValueError) as e:
+                        print(f"[RenderCache] Could not store {key}: {e}")
+                        self._drop(index, key)
+                        self._remove_files(key, list(arrays))
+                        self._save_index(index)
+                        return
+                    index[key] = {"arrays": list(arrays), "bytes": size, "used": time.time(), "meta": meta}
+                    for used_key, used in self._used.items():
+                        if used_key in index:
+                            index[used_key]["used"] = max(index[used_key]["used"], used)
+                    self._used.clear()
+                    self._collect_orphans(index)
+
+                    total = sum(entry["bytes"] for entry in index.values())
+                    for old_key in sorted(index, key=lambda k: index[k]["used"]):
+                        if total <= self.max_bytes:
+                            break
+                        if old_key != key:
+                            total -= index[old_key]["bytes"]
+                            self._drop(index, old_key)
+                    self._save_index(index)
+            except OSError as e:
+                print(f"[RenderCache] Could not update the index for {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            index = self._read_index()
+            return {
+                "entries": len(index),
+                "bytes": sum(entry["bytes"] for entry in index.values()),
+                "maxBytes": self.max_bytes,
+                "folder": self.folder,
+            }
+
+
+def defaultCacheFolder():
+    if CONFIG["render_cache_dir"]:
+        return CONFIG["render_cache_dir"]
+    import folder_paths
+    return os.path.join(folder_paths.get_output_directory(), "compositor", "render_cache")
+
+
+renderCache = RenderCache(defaultCacheFolder(), CONFIG["render_cache_mb"] * 1024 * 1024)
@@ -1,9 +1,10 @@
 try:
     from .nodes.Compositor4 import Compositor4
     from .nodes.Compositor3 import Compositor3
-    from .nodes.CompositorConfig4 import CompositorConfig4
-    from .nodes.Compositor4TransformsOut import Compositor4TransformsOut
+    from .nodes.CompositorConfig4 import CompositorConfig4, CompositorLayer4
+    from .nodes.Compositor4TransformsOut import Compositor4TransformsOut, Compositor4TransformsList
     from .nodes.Compositor4MasksOutput import Compositor4MasksOutput
+    from .nodes.Compositor4ApplyLayout import Compositor4ApplyLayout
 except ImportError:
     print("\033[34mBeyond Nodes: \033[92mFailed loading Compositor nodes\033[0m")
 
@@ -20,7 +21,7 @@ except ImportError:
     print("\033[34mBeyond Nodes: \033[92mFailed loading Logic nodes\033[0m")
 
 try:
-    from .nodes.Masking import Mask_Rectangular_Area, ImageMaskScaleAs, MaskToImage, MaskBoundingBox, EditMask, RoundMask
+    from .nodes.Masking import Mask_Rectangular_Area, ImageMaskScaleAs, MaskToImage, MaskBoundingBox, MaskPasteBack, EditMask, RoundMask
     
 except ImportError as e:
     print("\033[34mBeyond Nodes: \033[92mFailed loading Masking nodes\033[0m")
@@ -50,8 +51,11 @@ NODE_CLASS_MAPPINGS = {
     "Compositor3-beyond_nodes": Compositor3,
     "Compositor4-beyond_nodes": Compositor4,
     "CompositorConfig4-beyond_nodes": CompositorConfig4,
+    "CompositorLayer4-beyond_nodes": CompositorLayer4,
     "Compositor4TransformsOut-beyond_nodes": Compositor4TransformsOut,
+    "Compositor4TransformsList-beyond_nodes": Compositor4TransformsList,
     "Compositor4MasksOutput-beyond_nodes": Compositor4MasksOutput,
+    "Compositor4ApplyLayout-beyond_nodes": Compositor4ApplyLayout,
     ### Image Nodes
     "ImageScaleDownBy-beyond_nodes": ImageScaleDownBy,
     ### Logic Nodes
@@ -66,6 +70,7 @@ NODE_CLASS_MAPPINGS = {
     "MaskRectArea-beyond_nodes": Mask_Rectangular_Area,
     "MaskToImage-beyond_nodes": MaskToImage,
     "MaskBoundingBox-beyond_nodes": MaskBoundingBox,
+    "MaskPasteBack-beyond_nodes": MaskPasteBack,
     "ImageMaskScaleAs-beyond_nodes": ImageMaskScaleAs,
     ### Switch Nodes 
     "TwoWaySwitch-beyond_nodes": TwoWaySwitch,
@@ -86,8 +91,11 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "Compositor3-beyond_nodes": "🦾 Compositor V3 ",
     "Compositor4-beyond_nodes": "🦾 Compositor V4 ",
     "CompositorConfig4-beyond_nodes": "🦾 Compositor Config V4 🦾",
+    "CompositorLayer4-beyond_nodes": "🦾 Compositor Layer V4 🦾",
     "Compositor4TransformsOut-beyond_nodes": "🦾 Compositor Transforms Output V4 🦾",
+    "Compositor4TransformsList-beyond_nodes": "🦾 Compositor Transforms List V4 🦾",
     "Compositor4MasksOutput-beyond_nodes": "🦾 Compositor Masks Output V4 🦾",
+    "Compositor4ApplyLayout-beyond_nodes": "🦾 Compositor Apply Layout V4 🦾",
     ## Image Nodes
     "ImageScaleDownBy-beyond_nodes": "🦾 Image Scale Down By",
     ### Logic Nodes
@@ -102,6 +110,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "MaskRectArea-beyond_nodes": "Mask Rectangular Area 🦾",
     "MaskToImage-beyond_nodes": "Mask to Image 🦾",
     "MaskBoundingBox": "Mask Bounding Box 🦾",
+    "MaskPasteBack-beyond_nodes": "Mask Paste Back 🦾",
     "ImageMaskScaleAs-beyond_nodes": "Scale an Image/Mask as a Ref 🦾",
     ### Switch Nodes 
     "TwoWaySwitch-beyond_nodes": "Two Way Switch 🦾",
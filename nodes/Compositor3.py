@@ -1,25 +1,19 @@
 import folder_paths
 from PIL import Image, ImageOps
 import numpy as np
-import torch
 from comfy_execution.graph import ExecutionBlocker
 import threading
 from server import PromptServer
 from aiohttp import web
 import json # Added import for json parsing
+from ..common.compositorState import snapshotWaiters
+from ..common.imageFunctions import tensor2pil, pil2tensor
 
 thread = None
 g_node_id = None
 g_filename = None
 threads = []
 
-# Helper functions (assuming these are standard ComfyUI tensor/PIL conversions)
-def tensor2pil(image: torch.Tensor) -> Image.Image:
-    return Image.fromarray(np.clip(255. * image.cpu().numpy().squeeze(0), 0, 255).astype(np.uint8))
-
-def pil2tensor(image: Image.Image) -> torch.Tensor:
-    return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
-
 # Function to create an empty mask tensor of specified dimensions
 def create_empty_mask(width, height, inverted=False):
     """
@@ -183,7 +177,15 @@ def place_on_canvas(image_tensor, canvas_width, canvas_height, left, top, scale_
 routes = PromptServer.instance.routes
 @routes.post('/compositor/done')
 async def receivedDone(request):
-    return web.json_response({})
+    # the V3 editor posts a form and expects nothing back,
+    # the V4 editor posts its snapshot as JSON to resume a Compositor4 waiting in place
+    if request.content_type != "application/json":
+        return web.json_response({})
+    data = await request.json()
+    # same key as Compositor4.stateKey: (client_id, workflow_id, node_id)
+    state_key = (data.get("client_id") or "default", data.get("workflow_id") or "default", str(data.get("node_id")))
+    resumed = snapshotWaiters.resolve(state_key, data)
+    return web.json_response({"resumed": resumed})
 
 class Compositor3:
     file = "new.png"
@@ -278,9 +280,7 @@ class Compositor3:
             i = ImageOps.exif_transpose(i)
             if i.mode == 'I':
                 i = i.point(lambda i: i * (1 / 255))
-            image = i.convert("RGB")
-            image = np.array(image).astype(np.float32) / 255.0
-            image = torch.from_numpy(image)[None, ]
+            image = pil2tensor(i.convert("RGB"))
 
             # --- Image Rotation Logic ---
             rotated_images = [None] * 8
@@ -1,124 +1,52 @@
+import asyncio
+import time
 import folder_paths
+import comfy.model_management
 from server import PromptServer
 from comfy_execution.graph import ExecutionBlocker
+from aiohttp import web
 from PIL import Image, ImageOps
-import numpy as np
 import torch
 import json
 from typing_extensions import override
 from comfy_api.latest import ComfyExtension, io
+from ..common.compositorState import snapshotWaiters, compositorState
+from ..common.renderCache import renderCache, renderKey
+from ..common.config import CONFIG
+from ..common.imageFunctions import pil2tensor
+from ..common.compositorFunctions import CompositorTransforms, LayerPlacement, compact_image, compact_mask, composite_layers, constant_mask, expand_image, parse_color, plan_render, render_layer, stacking_order, visible_coverage
 
 
-# Helper functions for tensor/PIL conversions
-def tensor2pil(image: torch.Tensor) -> Image.Image:
-    return Image.fromarray(np.clip(255. * image.cpu().numpy().squeeze(0), 0, 255).astype(np.uint8))
+# compositor4_init fields the frontend applies together, resent as a group when any of them changes
+CANVAS_FIELDS = ("padding", "width", "height")
+# compositor4_init fields the frontend needs on every message to decide whether to save and re-queue
+CONTROL_FIELDS = ("node_id", "config_node_id", "configSignature", "configChanged", "onConfigChangedContinue", "awaitingSnapshot")
 
-def pil2tensor(image: Image.Image) -> torch.Tensor:
-    return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
 
-def create_empty_mask(width, height, inverted=False):
-    """Create an empty mask tensor with specified dimensions."""
-    try:
-        value = 255 if inverted else 0
-        empty_mask = Image.new('L', (width, height), value)
-        return pil2tensor(empty_mask)
-    except Exception as e:
-        print(f"Error creating empty mask: {e}")
-        value = 255 if inverted else 0
-        fallback_mask = Image.new('L', (1, 1), value)
-        return pil2tensor(fallback_mask)
-
-def place_on_canvas(image_tensor, canvas_width, canvas_height, left, top, scale_x=1.0, scale_y=1.0, mask_tensor=None, invert_mask=True):
+def compactInitMessage(previous, message):
     """
-    Place an image tensor on a canvas of specified dimensions at the given position.
-    Returns: Tuple of (positioned image tensor, positioned mask tensor)
+    Reduce a compositor4_init message to what changed since the previous one sent to the same client.
+    Slots are compared by file name and content hash, so the frontend only reloads layers that changed.
     """
-    if image_tensor is None:
-        return None, None
-        
-    try:
-        # Convert tensor to PIL for manipulation
-        pil_image = tensor2pil(image_tensor)
-        
-        # Convert to RGBA to preserve transparency
-        if pil_image.mode != 'RGBA':
-            pil_image = pil_image.convert('RGBA')
-            
-        # Create alpha channel if not already present
-        if len(pil_image.split()) < 4:
-            r, g, b = pil_image.split()
-            alpha = Image.new('L', pil_image.size, 255)
-            pil_image = Image.merge('RGBA', (r, g, b, alpha))
-            
-        # Convert mask tensor to PIL if provided
-        pil_mask = None
-        if mask_tensor is not None:
-            pil_mask = tensor2pil(mask_tensor)
-            if pil_mask.mode != 'L':
-                pil_mask = pil_mask.convert('L')
-        
-        # Apply scaling if needed
-        original_width, original_height = pil_image.size
-        if scale_x != 1.0 or scale_y != 1.0:
-            new_width = max(1, int(original_width * scale_x))
-            new_height = max(1, int(original_height * scale_y))
-            if new_width > 0 and new_height > 0:
-                pil_image = pil_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                if pil_mask is not None:
-                    pil_mask = pil_mask.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # Create a transparent canvas for the image
-        canvas = Image.new('RGBA', (canvas_width, canvas_height), (0, 0, 0, 0))
-        
-        # Create a mask canvas
-        mask_canvas = Image.new('L', (canvas_width, canvas_height), 255 if invert_mask else 0)
-        
-        # Calculate position with integer precision
-        pos_left = int(left)
-        pos_top = int(top)
-        
-        # Paste the image onto the canvas with transparency
-        canvas.paste(pil_image, (pos_left, pos_top), pil_image.split()[3])
-        
-        # Get the dimensions of the placed image
-        placed_width = min(pil_image.width, canvas_width - pos_left) if pos_left < canvas_width else 0
-        placed_height = min(pil_image.height, canvas_height - pos_top) if pos_top < canvas_height else 0
-        
-        # Create a bounding box mask
-        if placed_width > 0 and placed_height > 0:
-            bbox_value = 0
-            bbox_rect = Image.new('L', (placed_width, placed_height), bbox_value)
-            mask_canvas.paste(bbox_rect, (pos_left, pos_top))
-        
-        # Process the input mask if provided
-        if pil_mask is not None:
-            input_mask_canvas = Image.new('L', (canvas_width, canvas_height), 0)
-            input_mask_canvas.paste(pil_mask, (pos_left, pos_top))
-            
-            if invert_mask:
-                input_mask_canvas = ImageOps.invert(input_mask_canvas)
-            
-            mask_array = np.array(mask_canvas)
-            input_mask_array = np.array(input_mask_canvas)
-            
-            if invert_mask:
-                combined_array = np.maximum(mask_array, input_mask_array)
-            else:
-                combined_array = np.minimum(mask_array, input_mask_array)
-            
-            mask_canvas = Image.fromarray(combined_array.astype(np.uint8))
-        
-        # Convert back to tensors
-        r, g, b, a = canvas.split()
-        rgb_image = Image.merge('RGB', (r, g, b))
-        
-        positioned_image_tensor = pil2tensor(rgb_image)
-        positioned_mask_tensor = pil2tensor(mask_canvas)
-        
-        return positioned_image_tensor, positioned_mask_tensor
-    except Exception as e:
-        print(f"Error placing image on canvas: {e}")
-        return image_tensor, mask_tensor
+    if previous is None or previous.get("saveFolder") != message.get("saveFolder"):
+        # first message for this client (or every file moved): send everything
+        return message
+
+    compact = {key: message[key] for key in CONTROL_FIELDS}
+    if any(previous.get(key) != message[key] for key in CANVAS_FIELDS):
+        compact.update({key: message[key] for key in CANVAS_FIELDS})
+    for key, value in message.items():
+        if key not in compact and key not in CANVAS_FIELDS and key != "slots" and previous.get(key) != value:
+            compact[key] = value
+
+    previous_slots = previous.get("slots", {})
+    slots = {index: slot for index, slot in message["slots"].items() if previous_slots.get(index) != slot}
+    # slots that disappeared are sent empty so the frontend drops them
+    for index in previous_slots.keys() - message["slots"].keys():
+        slots[index] = {"name": None, "hash": None, "maskName": None, "maskHash": None}
+    if slots:
+        compact["slots"] = slots
+    return compact
 
 
 class Compositor4(io.ComfyNode):
@@ -126,8 +54,8 @@ class Compositor4(io.ComfyNode):
     V4 compositor node with integrated mask handling
     """
     
-    # Dictionary to cache config for each node instance, indexed by node_id
-    configCache = {}
+    # Per-node state (config signature, last compositor4_init per client) lives in compositorState,
+    # indexed by (client_id, workflow_id, node_id), see stateKey
     
     @classmethod
     def define_schema(cls) -> io.Schema:
@@ -141,15 +69,23 @@ class Compositor4(io.ComfyNode):
                 io.String.Input("imageName", default="", multiline=False, tooltip="Name of the snapshot image file. Auto-generated based on graph and node ID"),
                 io.String.Input("seed", default="0", multiline=False, tooltip="Random seed value that changes on each save to trigger node re-execution. Auto-updated by the compositor interface"),
                 io.Custom("COMPOSITOR_CONFIG").Input("config", tooltip="Configuration from CompositorConfig4 containing canvas size, images, masks, raw tensors, and settings"),
+                io.Boolean.Input("draft", default=False, optional=True, tooltip="Render layer outputs at draftScale with bilinear sampling. Turned on by the compositor interface for the runs it queues itself, off for runs you queue"),
+                io.Float.Input("draftScale", default=0.25, min=0.05, max=1.0, step=0.05, optional=True, tooltip="Canvas scale of the layer outputs in draft runs"),
+                io.Boolean.Input("compactLayers", default=True, optional=True, tooltip="Keep layer_outputs as uint8 images and uint8 or bit-packed masks, turned back to float by the node reading them. Uses 4 to 32 times less memory"),
             ],
             outputs=[
                 io.Image.Output(display_name="image", tooltip="Final composed image rendered from the compositor canvas"),
                 io.String.Output(display_name="fabricData_output", tooltip="Compositor state data (transforms, positions, etc.)"),
                 io.String.Output(display_name="imageName_output", tooltip="Filename of the saved composition snapshot"),
-                # io.String.Output(display_name="transforms", tooltip="JSON transform data for Compositor4TransformsOut node"),
                 io.Custom("COMPOSITOR_OUTPUT_MASKS").Output(display_name="layer_outputs", tooltip="Layer outputs (images and masks) for Compositor4MasksOutput node"),
+                io.Image.Output(display_name="layer_images", tooltip="Every visible layer on its own canvas, as one image batch ordered bottom to top"),
+                io.Mask.Output(display_name="layer_masks", tooltip="Masks of the layers in layer_images, one per batch entry (0 where the layer shows)"),
+                io.Mask.Output(display_name="visible_masks", tooltip="What is actually visible of each layer in layer_images once the layers above it are drawn, from z-order, visibility, opacity and alpha (0 where it shows)"),
+                io.Custom("COMPOSITOR_TRANSFORMS").Output(display_name="transforms", tooltip="Placement of every layer, parsed once, for Compositor4TransformsOut and Compositor4TransformsList"),
+                io.Image.Output(display_name="composite", tooltip="The layers composed on the server, with their blend modes and opacity, over the background color"),
             ],
             hidden=[
+                io.Hidden.prompt,
                 io.Hidden.extra_pnginfo,
                 io.Hidden.unique_id,
             ],
@@ -158,7 +94,87 @@ class Compositor4(io.ComfyNode):
 
 
     @classmethod
-    def execute(cls, fabricData, imageName, seed, config) -> io.NodeOutput:
+    def stateKey(cls, node_id, extra_pnginfo):
+        """
+        Key of this node's state: (client id, workflow id, node id), so neither the same workflow open in
+        two clients nor equal node ids in different workflows of one client share state.
+        """
+        workflow = extra_pnginfo.get("workflow") if isinstance(extra_pnginfo, dict) else None
+        workflow_id = workflow.get("id") if isinstance(workflow, dict) else None
+        return (PromptServer.instance.client_id or "default", workflow_id or "default", node_id)
+
+    @classmethod
+    def sendInit(cls, state_key, ui, config):
+        """
+        Send compositor4_init to the client that queued the prompt only, carrying what changed since the
+        last message this client got for the node. fabricData is left out: the frontend owns it.
+        """
+        node_id = state_key[-1]
+        client_id = PromptServer.instance.client_id
+        if client_id is None:
+            # queued through the API without a client, there is no editor to update
+            print(f"[Compositor4] No client for node {node_id}, skipping compositor4_init")
+            return
+
+        image_hashes = config.get("imageHashes", [])
+        mask_hashes = config.get("maskHashes", [])
+        # only connected slots are sent, a slot that goes away is sent empty by compactInitMessage
+        slots = {}
+        for index, name in enumerate(ui["names"]):
+            mask_name = ui["maskNames"][index] if index < len(ui["maskNames"]) else None
+            if name is None and mask_name is None:
+                continue
+            slots[str(index)] = {
+                "name": name,
+                "hash": image_hashes[index] if index < len(image_hashes) else None,
+                "maskName": mask_name,
+                "maskHash": mask_hashes[index] if index < len(mask_hashes) else None,
+            }
+
+        message = {key: value for key, value in ui.items() if key not in ("names", "maskNames", "fabricData")}
+        message["slots"] = slots
+
+        compact = compactInitMessage(compositorState.exchange(state_key, ("init", client_id), message), message)
+
+        print(f"[Compositor4] compositor4_init -> {client_id}: {sorted(compact.keys())}, slots={sorted(compact.get('slots', {}).keys())}")
+        detail = {"output": compact, "node": node_id}
+        PromptServer.instance.send_sync("compositor4_init", detail, client_id)
+
+    @classmethod
+    def forgetClient(cls, client_id, node_id=None):
+        """Drop what was sent to a client so its next compositor4_init is complete again."""
+        compositorState.forget(("init", client_id), node_id)
+
+    @classmethod
+    async def waitForSnapshot(cls, state_key, timeout):
+        """
+        Suspend until the editor posts its snapshot to /compositor/done, instead of blocking and re-queueing.
+        Returns the snapshot dict, or None on timeout or interrupt.
+        """
+        node_id = state_key[-1]
+        future = snapshotWaiters.wait(state_key)
+        waiter = asyncio.wrap_future(future)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"[Compositor4] No snapshot for node {node_id} after {timeout}s, blocking instead")
+                    return None
+                # wake up regularly so an interrupt from the UI is honored
+                done, _ = await asyncio.wait({waiter}, timeout=min(0.5, remaining))
+                if done:
+                    return waiter.result()
+                if comfy.model_management.processing_interrupted():
+                    print(f"[Compositor4] Interrupted while waiting for snapshot of node {node_id}")
+                    return None
+        except asyncio.CancelledError:
+            return None
+        finally:
+            snapshotWaiters.discard(state_key, future)
+
+    @classmethod
+    async def execute(cls, fabricData, imageName, seed, config, draft=False, draftScale=0.25, compactLayers=True) -> io.NodeOutput:
         # Access hidden inputs via cls.hidden
         node_id = cls.hidden.unique_id if cls.hidden else None
         extra_pnginfo = cls.hidden.extra_pnginfo if cls.hidden else None
@@ -172,7 +188,7 @@ class Compositor4(io.ComfyNode):
         if not config or not isinstance(config, dict):
             print(f"[Compositor4] Config invalid or missing")
             # If config is missing or invalid, we can't proceed
-            blocker_result = tuple([ExecutionBlocker(None)] * 3)  # V4: 3 outputs now
+            blocker_result = tuple([ExecutionBlocker(None)] * 9)  # V4: 9 outputs now
             ui = {"error": ["Config input required from CompositorConfig4 node"]}
             return io.NodeOutput(*blocker_result, ui=ui)
         
@@ -187,17 +203,21 @@ class Compositor4(io.ComfyNode):
         maskNames = config.get("maskNames", [])  # V4: Get mask filenames
         saveFolder = config.get("saveFolder", "output")
         configSignature = config.get("configSignature", None)
+        resumeInPlace = config.get("resumeInPlace", False)
+        resumeTimeout = config.get("resumeTimeout", 300)
 
         # Detect if configuration has changed since last run for this specific node
         # Use the config signature (hash) generated by CompositorConfig4
         # This signature changes whenever ANY input changes (images, masks, parameters)
-        cached_signature = cls.configCache.get(node_id)
+        # Read the previous signature and store the current one in one step, keyed by client, workflow and node
+        state_key = cls.stateKey(node_id, extra_pnginfo)
+        cached_signature = compositorState.exchange(state_key, "configSignature", configSignature)
         configChanged = cached_signature != configSignature
         
         print(f"[Compositor4] configChanged={configChanged}, onConfigChangedContinue={onConfigChangedContinue}")
-        
-        # Store the current signature using compositor node's ID as key
-        cls.configCache[node_id] = configSignature
+
+        # In-place resume: wait here for the snapshot instead of blocking and having the frontend re-queue
+        awaitingSnapshot = configChanged and resumeInPlace and PromptServer.instance.client_id is not None
 
         ui = {
             #"test": ("value",),
@@ -214,17 +234,24 @@ class Compositor4(io.ComfyNode):
             "configChanged": [configChanged],
             "onConfigChangedContinue": [onConfigChangedContinue],
             "saveFolder": [saveFolder],
+            "awaitingSnapshot": [awaitingSnapshot],
         }
 
-        print(ui)
+        cls.sendInit(state_key, ui, config)
 
-        detail = {"output": ui, "node": node_id}
-        PromptServer.instance.send_sync("compositor4_init", detail)
+        if awaitingSnapshot:
+            print(f"[Compositor4] Config changed, waiting up to {resumeTimeout}s for the snapshot")
+            snapshot = await cls.waitForSnapshot(state_key, resumeTimeout)
+            if snapshot is not None:
+                fabricData = snapshot.get("fabricData") or fabricData
+                imageName = snapshot.get("imageName") or imageName
+                ui["fabricData"] = [fabricData]
+                configChanged = False
 
         # when config changes, will always stop, frontend decides what to do next
         # this sends an executed event , with blocker
         if configChanged:
-            blocker_result = tuple([ExecutionBlocker(None)] * 3)  # V4: 3 outputs now
+            blocker_result = tuple([ExecutionBlocker(None)] * 9)  # V4: 9 outputs now
             print(f"[Compositor4] Config changed, blocking execution for user interaction, user decides what to do next")
             return io.NodeOutput(*blocker_result, ui=ui)
 
@@ -234,7 +261,7 @@ class Compositor4(io.ComfyNode):
         # Check if imageName is valid (not default/empty)
         if not imageName or imageName == "default" or imageName.strip() == "":
             print(f"[Compositor4] No valid imageName - this is first run or widget not set, blocking")
-            blocker_result = tuple([ExecutionBlocker(None)] * 3)  # V4: 3 outputs now
+            blocker_result = tuple([ExecutionBlocker(None)] * 9)  # V4: 9 outputs now
             return io.NodeOutput(*blocker_result, ui=ui)
         
         # Construct path based on saveFolder
@@ -243,7 +270,7 @@ class Compositor4(io.ComfyNode):
         if not imageExists:
             # Return ExecutionBlocker for all outputs if blocked
             print(f"[Compositor4] Image not found: {folder_path}")
-            blocker_result = tuple([ExecutionBlocker(None)] * 3)  # V4: 3 outputs now
+            blocker_result = tuple([ExecutionBlocker(None)] * 9)  # V4: 9 outputs now
             return io.NodeOutput(*blocker_result, ui=ui)
         image_path = folder_paths.get_annotated_filepath(folder_path)
         print(f"[Compositor4] Loading image: {image_path}")
@@ -251,162 +278,237 @@ class Compositor4(io.ComfyNode):
         i = ImageOps.exif_transpose(i)
         if i.mode == 'I':
             i = i.point(lambda i: i * (1 / 255))
-        image = i.convert("RGB")
-        image = np.array(image).astype(np.float32) / 255.0
-        image = torch.from_numpy(image)[None, ]
+        image = pil2tensor(i.convert("RGB"))
         
-        # V4: Prepare transforms output (JSON string for Compositor4TransformsOut)
-        transforms_output = fabricData  # fabricData already contains the transforms JSON
-        
-        # V4: Process individual layer images and masks with transforms
-        rotated_images = [None] * 8
-        rotated_masks = [None] * 8
+        # V4: Render individual layer images and masks with their transforms
         canvas_width = width
         canvas_height = height
-        
         try:
             fabric_data_parsed = json.loads(fabricData)
             canvas_width = int(fabric_data_parsed.get("width", width))
             canvas_height = int(fabric_data_parsed.get("height", height))
-            print(f"[Compositor4] Canvas dimensions: {canvas_width}x{canvas_height}")
-            
-            # Get transforms and bboxes arrays
-            fabric_transforms = fabric_data_parsed.get('transforms', [])
-            fabric_bboxes = fabric_data_parsed.get('bboxes', [])
-            
-            if not fabric_transforms:
-                fabric_transforms = [{} for _ in range(8)]
-            if not fabric_bboxes:
-                fabric_bboxes = [{} for _ in range(8)]
-            
-            # V4: Get raw image/mask tensors from config
-            raw_images = config.get("raw_images", [None] * 8)
-            raw_masks = config.get("raw_masks", [None] * 8)
-            
-            for idx in range(8):
-                # Get raw tensors from arrays
-                original_image_tensor = raw_images[idx] if idx < len(raw_images) else None
-                original_mask_tensor = raw_masks[idx] if idx < len(raw_masks) else None
-                
-                if original_image_tensor is not None and idx < len(fabric_transforms):
-                    # Get transformation data
-                    transform = fabric_transforms[idx]
-
-                    # NEW: handle visibility
-                    # Fabric typically puts `visible` on each object.
-                    # Default to True so old data (without this key) still works.
-                    visible = transform.get("visible", True)
-                    if not visible:
-                        print(f"[Compositor4] Layer {idx+1} is hidden, skipping")
-                        rotated_images[idx] = None
-                        rotated_masks[idx] = create_empty_mask(canvas_width, canvas_height)
-                        continue
-
-                    angle = transform.get('angle', 0)
-                    scale_x = transform.get('scaleX', 1.0)
-                    scale_y = transform.get('scaleY', 1.0)
-                    
-                    # Get positioning data from bboxes
-                    bbox = fabric_bboxes[idx] if idx < len(fabric_bboxes) else {'left': 0, 'top': 0}
-                    left = bbox.get('left', 0)
-                    top = bbox.get('top', 0)
-                    
-                    print(f"[Compositor4] Processing layer {idx+1}: angle={angle}, pos=({left},{top}), scale=({scale_x},{scale_y})")
-                    if original_mask_tensor is not None:
-                        print(f"[Compositor4]   - Mask found for layer {idx+1}")
-                    
-                    # Rotate if needed
-                    if angle != 0:
-                        try:
-                            pil_image = tensor2pil(original_image_tensor)
-                            rotated_pil = pil_image.rotate(-angle, expand=True, resample=Image.Resampling.BILINEAR)
-                            rotated_tensor = pil2tensor(rotated_pil)
-                            
-                            rotated_mask_tensor = None
-                            if original_mask_tensor is not None:
-                                pil_mask = tensor2pil(original_mask_tensor)
-                                rotated_pil_mask = pil_mask.rotate(-angle, expand=True, resample=Image.Resampling.BILINEAR)
-                                rotated_mask_tensor = pil2tensor(rotated_pil_mask)
-                            
-                            positioned_tensor, positioned_mask = place_on_canvas(
-                                rotated_tensor, 
-                                canvas_width, 
-                                canvas_height,
-                                left - padding,
-                                top - padding,
-                                scale_x,
-                                scale_y,
-                                rotated_mask_tensor
-                            )
-                            rotated_images[idx] = positioned_tensor
-                            rotated_masks[idx] = positioned_mask
-                        except Exception as e:
-                            print(f"[Compositor4] Error processing layer {idx+1}: {e}")
-                            positioned_tensor, positioned_mask = place_on_canvas(
-                                original_image_tensor,
-                                canvas_width,
-                                canvas_height,
-                                left,
-                                top,
-                                scale_x,
-                                scale_y,
-                                original_mask_tensor
-                            )
-                            rotated_images[idx] = positioned_tensor
-                            rotated_masks[idx] = positioned_mask
-                    else:
-                        # No rotation needed, just position and scale
-                        positioned_tensor, positioned_mask = place_on_canvas(
-                            original_image_tensor,
-                            canvas_width,
-                            canvas_height,
-                            left - padding,
-                            top - padding,
-                            scale_x,
-                            scale_y,
-                            original_mask_tensor
-                        )
-                        rotated_images[idx] = positioned_tensor
-                        rotated_masks[idx] = positioned_mask
-                elif original_image_tensor is not None:
-                    # No transform data, use original
-                    rotated_images[idx] = original_image_tensor
-                    rotated_masks[idx] = original_mask_tensor
-            
-            # Replace None masks with empty masks
-            for idx in range(8):
-                if rotated_masks[idx] is None:
-                    rotated_masks[idx] = create_empty_mask(canvas_width, canvas_height)
-            
-            # Create compositor output dict
-            layer_outputs = {
-                "images": rotated_images,
-                "masks": rotated_masks,
-                "canvas_width": canvas_width,
-                "canvas_height": canvas_height
-            }
-            
-            print(f"[Compositor4] Returning image with {sum(1 for img in rotated_images if img is not None)} processed layers")
-            return io.NodeOutput(image, fabricData, imageName, ui=ui)
-            
-        except json.JSONDecodeError:
+            fabric_transforms = fabric_data_parsed.get('transforms') or []
+            fabric_bboxes = fabric_data_parsed.get('bboxes') or []
+            fabric_positions = fabric_data_parsed.get('imagePositions')
+            locked_layer = fabric_data_parsed.get('lockedLayerIndex')
+        except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
             print("[Compositor4] Error parsing fabricData JSON. Returning empty layer outputs.")
-            empty_output = {
-                "images": [None] * 8,
-                "masks": [create_empty_mask(canvas_width, canvas_height) for _ in range(8)],
-                "canvas_width": canvas_width,
-                "canvas_height": canvas_height
-            }
-            return io.NodeOutput(image, fabricData, imageName, ui=ui)
-        except Exception as e:
-            print(f"[Compositor4] Unexpected error during layer processing: {e}")
-            empty_output = {
-                "images": [None] * 8,
-                "masks": [create_empty_mask(canvas_width, canvas_height) for _ in range(8)],
+            fabric_transforms = None
+            fabric_bboxes = None
+            fabric_positions = None
+            locked_layer = None
+        print(f"[Compositor4] Canvas dimensions: {canvas_width}x{canvas_height}")
+
+        try:
+            transforms = CompositorTransforms.from_fabric(fabric_data_parsed) if fabric_transforms is not None else CompositorTransforms()
+        except (AttributeError, TypeError, ValueError):
+            print("[Compositor4] Error reading layer transforms from fabricData. Returning empty transforms.")
+            transforms = CompositorTransforms()
+
+        render_scale = draftScale if draft else 1.0
+        layer_outputs = cls.cachedRenderLayers(config, fabricData, fabric_transforms, fabric_bboxes, padding, invertMask, canvas_width,
+                                               canvas_height, render_scale, fabric_positions, locked_layer)
+        layer_images = layer_outputs.pop("stacked_images")
+        layer_masks = layer_outputs.pop("stacked_masks")
+
+        # a render cache hit comes back as uint8 memory maps, layer_outputs keep them and the batches get floats
+        cache_hit = not layer_images.is_floating_point()
+        if cache_hit:
+            layer_images = expand_image(layer_images)
+            layer_masks = expand_image(layer_masks)
+        slots = layer_outputs["layer_slots"]
+        # visible_masks and composite are computed per pixel, on the same row tiles as the render
+        _, tile_rows = plan_render(layer_images.shape[2], layer_images.shape[1], len(slots), composite=True)
+        opacity = [float((fabric_transforms[idx] or {}).get("opacity", 1.0)) if idx < len(fabric_transforms) else 1.0
+                   for idx in slots]
+        if slots:
+            # hidden layers are not rendered, so they don't occlude anything either
+            visible_masks = visible_coverage(layer_masks, opacity, tile_rows)
+        else:
+            visible_masks = layer_masks
+
+        background = parse_color(fabric_data_parsed.get("backgroundColor")) if fabric_transforms is not None else (0.0, 0.0, 0.0)
+        if slots:
+            blend_modes = [((fabric_transforms[idx] if idx < len(fabric_transforms) else None) or {}).get("globalCompositeOperation") or "source-over"
+                           for idx in slots]
+            composite = composite_layers(layer_images, layer_masks, blend_modes, opacity, background, tile_rows)
+        else:
+            composite = torch.tensor(background).view(1, 1, 1, 3).repeat(1, layer_outputs["canvas_height"], layer_outputs["canvas_width"], 1)
+
+        if compactLayers and not cache_hit:
+            cls.compactLayerOutputs(layer_outputs, layer_images, layer_masks)
+
+        print(f"[Compositor4] Returning image with {sum(1 for img in layer_outputs['images'] if img is not None)} processed layers")
+        return io.NodeOutput(image, fabricData, imageName, layer_outputs, layer_images, layer_masks, visible_masks, transforms, composite, ui=ui)
+
+    @classmethod
+    def compactLayerOutputs(cls, layer_outputs, layer_images, layer_masks):
+        """
+        Replace the float layers of layer_outputs by compact copies: uint8 images, bit-packed masks when they
+        only hold 0 and 1, uint8 otherwise. Unpack nodes turn them back to float with expand_image/expand_mask.
+        """
+        images = layer_outputs["images"]
+        masks = layer_outputs["masks"]
+        compact_images = compact_image(layer_images)
+        for layer, idx in enumerate(layer_outputs["layer_slots"]):
+            if images[idx] is None:
+                # failed layer, it keeps its empty placeholder
+                continue
+            images[idx] = compact_images[layer:layer + 1]
+            masks[idx] = compact_mask(layer_masks[layer:layer + 1])
+
+    @classmethod
+    def cachedRenderLayers(cls, config, fabricData, transforms, bboxes, padding, invertMask, canvas_width, canvas_height,
+                           scale=1.0, positions=None, locked=None):
+        """
+        renderLayers through the on-disk render cache: full quality renders are stored compact (uint8) under a
+        fingerprint of the inputs, the fabricData and the canvas, and reloaded memory-mapped after a restart.
+        Reloaded layers are returned as the uint8 maps, like compact layer_outputs. Drafts are not cached.
+        """
+        if scale < 1.0 or not renderCache.enabled or transforms is None:
+            return cls.renderLayers(config, transforms, bboxes, padding, invertMask, canvas_width, canvas_height, scale, positions, locked)
+
+        raw_images = config.get("raw_images", [])
+        raw_masks = config.get("raw_masks", [])
+        key = renderKey(
+            config.get("imageHashes"), config.get("maskHashes"),
+            [None if image is None else list(image.shape) for image in raw_images],
+            [None if mask is None else list(mask.shape) for mask in raw_masks],
+            invertMask, padding, fabricData, canvas_width, canvas_height,
+        )
+
+        cached = renderCache.get(key)
+        if cached is not None:
+            arrays, meta = cached
+            print(f"[Compositor4] Render cache hit {key}, {len(meta['slots'])} layers")
+            # layers stay uint8 memory maps, like compact layer_outputs: run and the unpack nodes expand what they read
+            stacked_images = arrays["images"]
+            stacked_masks = arrays["masks"]
+            images = [None] * len(raw_images)
+            masks = [constant_mask(canvas_width, canvas_height, 1.0)] * len(raw_images)
+            for layer, idx in enumerate(meta["slots"]):
+                images[idx] = stacked_images[layer:layer + 1]
+                masks[idx] = stacked_masks[layer:layer + 1]
+            return {
+                "images": images,
+                "masks": masks,
                 "canvas_width": canvas_width,
-                "canvas_height": canvas_height
+                "canvas_height": canvas_height,
+                "scale": scale,
+                "layer_slots": meta["slots"],
+                "stacked_images": stacked_images,
+                "stacked_masks": stacked_masks,
             }
-            return io.NodeOutput(image, fabricData, imageName, ui=ui)
+
+        result = cls.renderLayers(config, transforms, bboxes, padding, invertMask, canvas_width, canvas_height, scale, positions, locked)
+        slots = result["layer_slots"]
+        # nothing worth keeping without layers, and a failed layer may render next time
+        if slots and all(result["images"][idx] is not None for idx in slots):
+            renderCache.put(key, {"images": compact_image(result["stacked_images"]), "masks": compact_image(result["stacked_masks"])},
+                            {"slots": slots})
+        return result
+
+    @classmethod
+    def renderLayers(cls, config, transforms, bboxes, padding, invertMask, canvas_width, canvas_height, scale=1.0,
+                     positions=None, locked=None):
+        """
+        Render every connected, visible layer on its own canvas-sized image and mask (mask is 0 where the layer shows).
+        Layers are sampled straight into preallocated outputs, in row tiles when the estimated peak memory
+        is over the render budget, so working memory follows the tile size rather than the canvas.
+        A scale below 1 is a draft: the canvas is scaled down and sampled bilinearly, so the cost of interactive
+        runs follows the preview size.
+        The rendered layers share one [L, H, W, 3] image and one [L, H, W] mask tensor, allocated once and filled in
+        place and ordered bottom to top like the editor stacks them (positions, locked); the per-slot lists hold views.
+        """
+        mode = "bicubic"
+        if scale < 1.0:
+            mode = "bilinear"
+            canvas_width = max(1, round(canvas_width * scale))
+            canvas_height = max(1, round(canvas_height * scale))
+
+        raw_images = config.get("raw_images", [])
+        raw_masks = config.get("raw_masks", [])
+        images = [None] * len(raw_images)
+        masks = [None] * len(raw_images)
+
+        layers = []
+        for idx, image in enumerate(raw_images):
+            if image is None or transforms is None:
+                continue
+            transform = (transforms[idx] if idx < len(transforms) else None) or {}
+            # Fabric puts `visible` on each object, default to True so old data (without this key) still works
+            if not transform.get("visible", True):
+                print(f"[Compositor4] Layer {idx+1} is hidden, skipping")
+                continue
+            bbox = (bboxes[idx] if idx < len(bboxes) else None) or {}
+            mask = raw_masks[idx] if idx < len(raw_masks) else None
+            layers.append((idx, image, mask, transform, bbox))
+        order = stacking_order([idx for idx, *_ in layers], positions, locked)
+        layers.sort(key=lambda layer: order.index(layer[0]))
+
+        estimate, tile_rows = plan_render(canvas_width, canvas_height, len(layers), composite=True)
+        print(f"[Compositor4] Rendering {len(layers)} {mode} layers at {canvas_width}x{canvas_height}: ~{estimate / 2**20:.0f} MB, "
+              + ("single pass" if tile_rows is None else f"tiles of {tile_rows} rows"))
+        if estimate > CONFIG["render_budget_mb"] * 2**20:
+            print(f"[Compositor4] Warning: the outputs alone are over the {CONFIG['render_budget_mb']} MB render budget "
+                  "(BEYOND_NODES_RENDER_BUDGET_MB), tiling can't bring the peak under it")
+
+        if layers:
+            stacked_images = torch.zeros((len(layers), canvas_height, canvas_width, 3), dtype=torch.float32)
+            stacked_masks = torch.ones((len(layers), canvas_height, canvas_width), dtype=torch.float32)
+        else:
+            # nothing to show, a single empty layer keeps the outputs usable
+            stacked_images = torch.zeros((1, canvas_height, canvas_width, 3), dtype=torch.float32)
+            stacked_masks = torch.ones((1, canvas_height, canvas_width), dtype=torch.float32)
+
+        for layer, (idx, image, mask, transform, bbox) in enumerate(layers):
+            try:
+                frame_height, frame_width = image.shape[-3:-1]
+                placement = LayerPlacement(transform, bbox, padding, frame_width, frame_height, scale)
+                print(f"[Compositor4] Processing layer {idx+1}: angle={placement.angle}, pos=({placement.left},{placement.top}), scale=({placement.scale_x},{placement.scale_y})")
+                if mask is not None and invertMask:
+                    mask = 1.0 - mask
+
+                render_layer(image, mask, placement, stacked_images[layer], stacked_masks[layer], mode=mode, tile_rows=tile_rows)
+                images[idx] = stacked_images[layer:layer + 1]
+                masks[idx] = stacked_masks[layer:layer + 1]
+            except Exception as e:
+                print(f"[Compositor4] Error processing layer {idx+1}: {e}")
+                # a failed layer shows nothing, even if some tiles were written
+                stacked_images[layer].zero_()
+                stacked_masks[layer].fill_(1.0)
+
+        # Missing, hidden or failed layers show nothing
+        for idx in range(len(masks)):
+            if masks[idx] is None:
+                masks[idx] = constant_mask(canvas_width, canvas_height, 1.0)
+
+        return {
+            "images": images,
+            "masks": masks,
+            "canvas_width": canvas_width,
+            "canvas_height": canvas_height,
+            "scale": scale,
+            "layer_slots": [idx for idx, *_ in layers],
+            "stacked_images": stacked_images,
+            "stacked_masks": stacked_masks,
+        }
+
+routes = PromptServer.instance.routes
+# /compositor/done, which resolves waitForSnapshot, is registered next to the V3 compositor
+@routes.post('/compositor4/resync')
+async def compositor4Resync(request):
+    """Called by an editor that has nothing loaded yet, so the next compositor4_init it gets is complete."""
+    data = await request.json()
+    node_id = data.get("node_id")
+    Compositor4.forgetClient(data.get("client_id"), None if node_id is None else str(node_id))
+    return web.json_response({})
+
+
+@routes.get('/compositor/stats')
+async def compositorStats(request):
+    """Size and hit/eviction counters of the shared compositor state, for monitoring."""
+    return web.json_response({"state": compositorState.stats(), "waiting": len(snapshotWaiters), "renderCache": renderCache.stats()})
 
 
 class Compositor4Extension(ComfyExtension):
@@ -0,0 +1,92 @@
+import torch
+from typing_extensions import override
+from comfy_api.latest import ComfyExtension, io
+from ..common.compositorFunctions import CompositorTransforms, plan_render, render_maps
+
+
+class Compositor4ApplyLayout(io.ComfyNode):
+    """
+    Redo a Compositor4 layout on auxiliary maps (depth, normals, pose or ControlNet hints) of each layer,
+    with the placement the layer images got, and compose them on one canvas.
+    """
+
+    @classmethod
+    def define_schema(cls) -> io.Schema:
+        return io.Schema(
+            node_id="Compositor4ApplyLayout-beyond_nodes",
+            display_name="🦾 Compositor Apply Layout V4 🦾",
+            category="image",
+            description="Places auxiliary maps (depth, normal, pose, ControlNet hints...) of each compositor layer exactly where Compositor V4 placed the layer images, in z-order with the layer masks, and composes them on a canvas. Each map input can be a batch of N maps, all warped in one pass. Maps can have another resolution than the layer image.",
+            inputs=[
+                io.Custom("COMPOSITOR_CONFIG").Input("config", tooltip="The config given to Compositor V4, for the layer image sizes and masks"),
+                io.Custom("COMPOSITOR_TRANSFORMS").Input("transforms", tooltip="transforms output of Compositor V4"),
+                io.Combo.Input("resampling", options=["bicubic", "bilinear", "nearest"], default="bicubic", tooltip="bicubic matches the layer images, nearest keeps label and pose maps crisp"),
+                io.Boolean.Input("useLayerMasks", default=True, tooltip="Cut the maps with the layer masks like the layer images are"),
+                io.Float.Input("background", default=0.0, min=0.0, max=1.0, step=0.01, tooltip="Value of the canvas where no layer is placed"),
+                io.Image.Input("map1", optional=True, tooltip="Maps of layer 1 (optional)"),
+                io.Image.Input("map2", optional=True, tooltip="Maps of layer 2 (optional)"),
+                io.Image.Input("map3", optional=True, tooltip="Maps of layer 3 (optional)"),
+                io.Image.Input("map4", optional=True, tooltip="Maps of layer 4 (optional)"),
+                io.Image.Input("map5", optional=True, tooltip="Maps of layer 5 (optional)"),
+                io.Image.Input("map6", optional=True, tooltip="Maps of layer 6 (optional)"),
+                io.Image.Input("map7", optional=True, tooltip="Maps of layer 7 (optional)"),
+                io.Image.Input("map8", optional=True, tooltip="Maps of layer 8 (optional)"),
+                io.Custom("COMPOSITOR_LAYERS").Input("maps", optional=True, tooltip="Maps of layer 9 onwards, from a chain of Compositor Layer V4 nodes (their masks are ignored)"),
+            ],
+            outputs=[
+                io.Image.Output(display_name="image", tooltip="The composed maps, one canvas per map of the batch"),
+                io.Mask.Output(display_name="mask", tooltip="Where the placed maps show (0) and where the background does (1)"),
+            ],
+        )
+
+    @classmethod
+    def execute(cls, config, transforms: CompositorTransforms, resampling, useLayerMasks, background,
+                map1=None, map2=None, map3=None, map4=None, map5=None, map6=None, map7=None, map8=None,
+                maps=None) -> io.NodeOutput:
+        slot_maps = [map1, map2, map3, map4, map5, map6, map7, map8, *[layer["image"] for layer in maps or []]]
+        raw_images = config.get("raw_images", [])
+        raw_masks = config.get("raw_masks", [])
+        invertMask = config.get("invertMask", False)
+        canvas_width = transforms.canvas_width or config.get("width", 512)
+        canvas_height = transforms.canvas_height or config.get("height", 512)
+
+        layers = []
+        for idx in transforms.order:
+            if idx >= len(slot_maps) or slot_maps[idx] is None or not transforms.visible[idx]:
+                continue
+            image = raw_images[idx] if idx < len(raw_images) else None
+            if image is None:
+                print(f"[Compositor4ApplyLayout] Layer {idx+1} has maps but no image in the config, skipping")
+                continue
+            layers.append((idx, slot_maps[idx], image))
+
+        count = max([layer_maps.shape[0] for _, layer_maps, _ in layers], default=1)
+        out_maps = torch.full((count, canvas_height, canvas_width, 3), float(background), dtype=torch.float32)
+        out_mask = torch.ones((canvas_height, canvas_width), dtype=torch.float32)
+
+        # all the maps of a layer are sampled together, so a tile row costs count times more
+        _, tile_rows = plan_render(canvas_width * count, canvas_height, 1)
+
+        for idx, layer_maps, image in layers:
+            layer_maps = layer_maps[..., :3]
+            if layer_maps.shape[0] != count:
+                layer_maps = layer_maps[:1].expand(count, -1, -1, -1)
+            mask = raw_masks[idx] if useLayerMasks and idx < len(raw_masks) else None
+            if mask is not None and invertMask:
+                mask = 1.0 - mask
+            frame_height, frame_width = image.shape[-3:-1]
+            placement = transforms.placement(idx, frame_width, frame_height)
+            render_maps(layer_maps, mask, (frame_height, frame_width), placement, out_maps, out_mask, resampling, tile_rows)
+
+        print(f"[Compositor4ApplyLayout] Placed the maps of {len(layers)} layers on {count} {canvas_width}x{canvas_height} canvases")
+        return io.NodeOutput(out_maps, out_mask.unsqueeze(0))
+
+
+class Compositor4ApplyLayoutExtension(ComfyExtension):
+    @override
+    async def get_node_list(self) -> list[type[io.ComfyNode]]:
+        return [Compositor4ApplyLayout]
+
+
+async def comfy_entrypoint() -> Compositor4ApplyLayoutExtension:
+    return Compositor4ApplyLayoutExtension()
@@ -8,6 +8,7 @@
 # from aiohttp import web
 
 import json
+from ..common.compositorFunctions import CompositorTransforms
 
 
 class Compositor4TransformsOut:
@@ -16,11 +17,15 @@ class Compositor4TransformsOut:
     def INPUT_TYPES(cls):
         return {
             "required": {
-                "transforms": ("STRING", {"forceInput": True}),
-                "channel": ("INT", {"min": 1, "max": 8, "default": 1}),
+                "channel": ("INT", {"min": 1, "max": 64, "default": 1}),
                 "forceInt": ("BOOLEAN", {"default": True}),
 
             },
+            "optional": {
+                # pre-parsed transforms from Compositor4, or the fabricData string (parsed on every run)
+                "compositor_transforms": ("COMPOSITOR_TRANSFORMS",),
+                "transforms": ("STRING", {"forceInput": True}),
+            },
             "hidden": {
                 "extra_pnginfo": "EXTRA_PNGINFO",
                 "node_id": "UNIQUE_ID",
@@ -36,30 +41,49 @@ class Compositor4TransformsOut:
     def run(self, **kwargs):
         node_id = kwargs.pop('node_id', None)
         channel = kwargs.pop('channel', 1)
-        transforms = kwargs.pop('transforms', {})
+        transforms = kwargs.pop('transforms', None)
+        compositor_transforms = kwargs.pop('compositor_transforms', None)
         forceInt = kwargs.pop('forceInt', {})
-        # print(transforms)
-        data = json.loads(transforms)
-        padding = data["padding"]
-        # extract transforms
-        t = data["transforms"]
-        width = t[channel - 1]["xwidth"] * t[channel - 1]["scaleX"]
-        height = t[channel - 1]["xheight"] * t[channel - 1]["scaleY"]
-        # remove the padding as transforms are padding based
-        x = t[channel - 1]["left"] - padding
-        y = t[channel - 1]["top"] - padding
-        #angle
-        angle = t[channel - 1]["angle"]
-
-        # bounding box out
-        b = data["bboxes"]
-        bwidth = b[channel - 1]["xwidth"]
-        bheight = b[channel - 1]["xheight"]
-        # remove the padding as transforms are padding based
-        bx = b[channel - 1]["left"] - padding
-        by = b[channel - 1]["top"] - padding
+        if compositor_transforms is None:
+            if transforms is None:
+                raise ValueError("Compositor4TransformsOut needs compositor_transforms or transforms connected")
+            try:
+                compositor_transforms = CompositorTransforms.from_fabric(json.loads(transforms))
+            except (json.JSONDecodeError, AttributeError, TypeError) as e:
+                raise ValueError(f"Compositor4TransformsOut: transforms is not compositor fabricData JSON ({e})") from e
+        # transforms are padding based, the padding is already removed
+        values = compositor_transforms.layer(channel - 1)
 
         if forceInt:
-            return (int(x), int(y), int(width), int(height), int(angle), int(bx), int(by), int(bwidth), int(bheight))
+            return tuple(int(value) for value in values)
         else:
-            return (x, y, width, height, angle, bx, by, bwidth, bheight)
+            return values
+
+
+class Compositor4TransformsList:
+    """
+    All layers of a COMPOSITOR_TRANSFORMS at once: each output is a list with one value per layer
+    (layers without an image included, as zeros), so downstream nodes run once per layer.
+    """
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "compositor_transforms": ("COMPOSITOR_TRANSFORMS",),
+                "forceInt": ("BOOLEAN", {"default": True}),
+            },
+        }
+
+    RETURN_TYPES = ("INT", "INT", "INT", "INT", "INT", "INT", "INT", "INT", "INT", "BOOLEAN")
+    RETURN_NAMES = ("x", "y", "width", "height", "angle", "bbox x", "bbox y", "bbox width", "bbox height", "present")
+    OUTPUT_IS_LIST = (True,) * 10
+
+    FUNCTION = "run"
+    CATEGORY = "image"
+
+    def run(self, compositor_transforms, forceInt=True):
+        columns = [getattr(compositor_transforms, field) for field in CompositorTransforms.FIELDS]
+        if forceInt:
+            columns = [[int(value) for value in column] for column in columns]
+        return (*[list(column) for column in columns], list(compositor_transforms.present))
@@ -1,6 +1,5 @@
-import torch
-import numpy as np
 from PIL import Image
+from ..common.imageFunctions import pil2tensor
 
 class CompositorColorPicker:
     """
@@ -80,11 +79,8 @@ class CompositorColorPicker:
         # Create a solid color image
         img = Image.new('RGB', (size, size), (r, g, b))
         
-        # Convert to numpy array and normalize to 0-1 range
-        img_np = np.array(img).astype(np.float32) / 255.0
-        
-        # Convert to tensor with batch dimension
-        return torch.from_numpy(img_np)[None, ]
+        # Convert to a 0-1 tensor with batch dimension
+        return pil2tensor(img)
     
     def convert_color(self, red, green, blue, format="RGB565"):
         """
@@ -1,5 +1,4 @@
 import nodes
-import numpy as np
 import base64
 from io import BytesIO
 from PIL import Image
@@ -8,15 +7,11 @@ import torch
 import torch.nn.functional as F
 import math
 from comfy.utils import common_upscale
+from ..common.imageFunctions import tensor2pil
 
 MAX_RESOLUTION = nodes.MAX_RESOLUTION
 
 
-# these probably exist elsewhere as utils
-def tensor2pil(image):
-    return Image.fromarray(np.clip(255. * image.cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
-
-
 # these probably exist elsewhere as utils
 def toBase64ImgUrl(img):
     bytesIO = BytesIO()
@@ -11,17 +11,13 @@ import os
 import hashlib
 import time
 from comfy.utils import common_upscale
+from ..common.imageFunctions import tensor2pil
 from typing_extensions import override
 from comfy_api.latest import ComfyExtension, io
 
 MAX_RESOLUTION = nodes.MAX_RESOLUTION
 
 
-# these probably exist elsewhere as utils
-def tensor2pil(image):
-    return Image.fromarray(np.clip(255. * image.cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
-
-
 # these probably exist elsewhere as utils
 def toBase64ImgUrl(img):
     bytesIO = BytesIO()
@@ -31,6 +27,11 @@ def toBase64ImgUrl(img):
     return f"data:image/png;base64,{img_base64.decode('utf-8')}"
 
 
+# Short digest of pixel data, lets Compositor4 tell the frontend which slots actually changed
+def contentHash(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
 # Save image to specified folder/compositor subfolder and return filename
 def saveImageToCompositorFolder(img, config_node_id, index, save_format, save_folder):
     """
@@ -129,17 +130,8 @@ def saveMaskToCompositorFolder(mask_tensor, config_node_id, index, save_folder):
     os.makedirs(compositor_dir, exist_ok=True)
     
     # Convert mask tensor to PIL Image (grayscale)
-    # mask_tensor shape: [batch, height, width] or [height, width]
-    if mask_tensor.ndim == 3:
-        mask_np = mask_tensor[0].cpu().numpy()  # Take first batch
-    else:
-        mask_np = mask_tensor.cpu().numpy()
-    
-    # Convert to 0-255 range
-    mask_np = np.clip(255. * mask_np, 0, 255).astype(np.uint8)
-    
-    # Create PIL Image in grayscale mode
-    mask_img = Image.fromarray(mask_np, mode='L')
+    # mask_tensor shape: [batch, height, width] or [height, width], take the first batch
+    mask_img = tensor2pil(mask_tensor[0] if mask_tensor.ndim == 3 else mask_tensor)
     
     # Generate persistent filename
     filename = f"cfg{config_node_id}-mask{index}.png"
@@ -187,6 +179,9 @@ class CompositorConfig4(io.ComfyNode):
                 io.Mask.Input("mask7", optional=True, tooltip="Alpha mask for seventh image (optional)"),
                 io.Image.Input("image8", optional=True, tooltip="Eighth input image (optional)"),
                 io.Mask.Input("mask8", optional=True, tooltip="Alpha mask for eighth image (optional)"),
+                io.Boolean.Input("resumeInPlace", default=False, optional=True, label_off="block and re-queue", label_on="wait in place", tooltip="When the config changes, the compositor waits inside the running prompt for the snapshot instead of blocking and re-queueing the whole workflow"),
+                io.Int.Input("resumeTimeout", default=300, min=1, max=3600, step=1, optional=True, tooltip="Seconds the compositor waits for the snapshot in 'wait in place' mode before falling back to blocking"),
+                io.Custom("COMPOSITOR_LAYERS").Input("layers", optional=True, tooltip="More layers from a chain of Compositor Layer V4 nodes, placed after image8 (layer 9 onwards)"),
             ],
             outputs=[
                 io.Custom("COMPOSITOR_CONFIG").Output(display_name="config", tooltip="Configuration object containing compositor settings and processed images with mask filenames"),
@@ -202,7 +197,7 @@ class CompositorConfig4(io.ComfyNode):
     def execute(cls, width, height, padding, normalizeHeight, onConfigChangedContinue, invertMask, saveFormat, saveFolder,
                 image1=None, mask1=None, image2=None, mask2=None, image3=None, mask3=None,
                 image4=None, mask4=None, image5=None, mask5=None, image6=None, mask6=None,
-                image7=None, mask7=None, image8=None, mask8=None) -> io.NodeOutput:
+                image7=None, mask7=None, image8=None, mask8=None, resumeInPlace=False, resumeTimeout=300, layers=None) -> io.NodeOutput:
         
         import random
         hash_input = str(random.random())
@@ -226,13 +221,20 @@ class CompositorConfig4(io.ComfyNode):
             "image3": image3, "mask3": mask3, "image4": image4, "mask4": mask4,
             "image5": image5, "mask5": mask5, "image6": image6, "mask6": mask6,
             "image7": image7, "mask7": mask7, "image8": image8, "mask8": mask8,
+            "resumeInPlace": resumeInPlace, "resumeTimeout": resumeTimeout,
             "prompt": prompt, "extra_pnginfo": extra_pnginfo, "node_id": node_id
         }
 
         images = [image1, image2, image3, image4, image5, image6, image7, image8, ]
         masks = [mask1, mask2, mask3, mask4, mask5, mask6, mask7, mask8, ]
+        # chained layers come after the 8 fixed slots, as many as are connected
+        for layer in layers or []:
+            images.append(layer["image"])
+            masks.append(layer["mask"])
         input_images = []
         mask_filenames = []  # V4: Track mask filenames
+        image_hashes = []  # V4: Per-slot content hashes so the frontend only reloads changed layers
+        mask_hashes = []
 
         # Generate a random hash that changes on every execution
         # This forces the Compositor4 node to re-execute every time
@@ -259,6 +261,7 @@ class CompositorConfig4(io.ComfyNode):
                     # V4: Save mask to disk
                     mask_filename = saveMaskToCompositorFolder(mask, node_id, index, saveFolder)
                     mask_filenames.append(mask_filename)
+                    mask_hashes.append(contentHash(np.ascontiguousarray(mask.cpu().numpy())))
                     
                     if applyMaskInConfig:
                         # Mode 1: Apply mask in config (create RGBA)
@@ -266,14 +269,17 @@ class CompositorConfig4(io.ComfyNode):
                         i = tensor2pil(masked[0])
                         filename = saveImageToCompositorFolder(i, node_id, index, saveFormat, saveFolder)
                         input_images.append(filename)
+                        image_hashes.append(contentHash(i.tobytes()))
                     else:
                         # Mode 2: Save RGB without mask (frontend will apply via clipPath)
                         i = tensor2pil(img)
                         filename = saveImageToCompositorFolder(i, node_id, index, saveFormat, saveFolder)
                         input_images.append(filename)
+                        image_hashes.append(contentHash(i.tobytes()))
                 else:
                     # V4: No mask, append None to maintain index alignment
                     mask_filenames.append(None)
+                    mask_hashes.append(None)
                     
                     # no mask to apply
                     i = tensor2pil(img)
@@ -281,9 +287,12 @@ class CompositorConfig4(io.ComfyNode):
                     # Use index (0-7) for the input slot number
                     filename = saveImageToCompositorFolder(i, node_id, index, saveFormat, saveFolder)
                     input_images.append(filename)
+                    image_hashes.append(contentHash(i.tobytes()))
             else:
                 # V4: No image, append None to both lists
                 mask_filenames.append(None)
+                mask_hashes.append(None)
+                image_hashes.append(None)
                 # input is None, forward
                 input_images.append(img)
 
@@ -296,12 +305,16 @@ class CompositorConfig4(io.ComfyNode):
             "padding": padding,
             "names": input_images,
             "maskNames": mask_filenames,  # V4: Add mask filenames to config
+            "imageHashes": image_hashes,  # V4: Content hashes of the saved images, per slot
+            "maskHashes": mask_hashes,  # V4: Content hashes of the saved masks, per slot
             "onConfigChangedContinue": onConfigChangedContinue,
             "normalizeHeight": normalizeHeight,
             "invertMask": invertMask,
             "applyMaskInConfig": applyMaskInConfig,  # V4: Pass mask application mode to compositor
             "saveFolder": saveFolder,
             "configSignature": hash_input,  # Hash that changes on every execution
+            "resumeInPlace": resumeInPlace,  # Wait for the snapshot inside the prompt instead of re-queueing
+            "resumeTimeout": resumeTimeout,
             # V4: Include raw tensors for layer processing
             "raw_images": images,
             "raw_masks": masks,
@@ -433,11 +446,40 @@ def prepare_mask(mask, foo_is_batch):
     return mask
 
 
+class CompositorLayer4(io.ComfyNode):
+    """
+    One more compositor layer, chained to reach past the 8 fixed slots of CompositorConfig4.
+    Each node appends its image and mask to the incoming list, so the layer count follows the chain length.
+    """
+
+    @classmethod
+    def define_schema(cls) -> io.Schema:
+        return io.Schema(
+            node_id="CompositorLayer4-beyond_nodes",
+            display_name="🦾 Compositor Layer V4 🦾",
+            category="image",
+            description="Adds one image (with an optional mask) to a list of compositor layers. Chain as many as needed and connect the last one to the 'layers' input of Compositor Config V4: they become layers 9, 10, ... in chain order.",
+            inputs=[
+                io.Image.Input("image", tooltip="Layer image"),
+                io.Mask.Input("mask", optional=True, tooltip="Alpha mask for the layer image (optional)"),
+                io.Custom("COMPOSITOR_LAYERS").Input("layers", optional=True, tooltip="Layers from the previous Compositor Layer V4 node"),
+            ],
+            outputs=[
+                io.Custom("COMPOSITOR_LAYERS").Output(display_name="layers", tooltip="The incoming layers followed by this one"),
+            ],
+        )
+
+    @classmethod
+    def execute(cls, image, mask=None, layers=None) -> io.NodeOutput:
+        # a new list, the upstream output may be cached and reused by another branch
+        return io.NodeOutput([*(layers or []), {"image": image, "mask": mask}])
+
+
 # V4 Extension and Entry Point
 class CompositorConfig4Extension(ComfyExtension):
     @override
     async def get_node_list(self) -> list[type[io.ComfyNode]]:
-        return [CompositorConfig4]
+        return [CompositorConfig4, CompositorLayer4]
 
 
 async def comfy_entrypoint() -> CompositorConfig4Extension:
@@ -1,6 +1,5 @@
 import torch
-from PIL import Image
-import numpy as np
+from ..common.compositorFunctions import expand_image, expand_mask, subtract_masks as subtractMasks
 
 class CompositorMasksOutputV3:
     """
@@ -14,8 +13,9 @@ class CompositorMasksOutputV3:
             "required": {
                 "layer_outputs": ("COMPOSITOR_OUTPUT_MASKS",),
             },
-            "hidden": {
-                "subtract_masks": ("BOOLEAN", {"default": False}),
+            "optional": {
+                "subtract_masks": ("BOOLEAN", {"default": False, "tooltip": "Remove from each mask what the layers above it cover, so the masks don't overlap"}),
+                "first_layer": ("INT", {"default": 1, "min": 1, "max": 64, "tooltip": "Layer unpacked as image_1/mask_1, the next seven follow: 9 gives layers 9 to 16 of a Compositor Layer V4 chain"}),
             }
         }
 
@@ -28,14 +28,15 @@ class CompositorMasksOutputV3:
     FUNCTION = "unpack_outputs"
     CATEGORY = "image"
 
-    def unpack_outputs(self, layer_outputs, subtract_masks=False):
+    def unpack_outputs(self, layer_outputs, subtract_masks=False, first_layer=1):
         """
         Unpacks the layer_outputs dictionary into individual image and mask outputs.
         
         Args:
             layer_outputs: Dictionary containing 'images', 'masks', 'canvas_width', and 'canvas_height'
-            subtract_masks: When True, each mask will have higher-numbered masks subtracted from it
-                           (e.g., mask 6 = mask 6 - mask 7, mask 5 = mask 5 - mask 6, etc.)
+            subtract_masks: When True, each mask will have every higher-numbered mask subtracted from it
+                           (mask 6 = mask 6 - mask 7 - mask 8, etc.), layers past the eight unpacked included
+            first_layer: Layer number (1-based slot) of the first output, the eight from it are unpacked
             
         Returns:
             Tuple of 16 tensors: 8 images and 8 masks in order
@@ -47,53 +48,34 @@ class CompositorMasksOutputV3:
         canvas_width = layer_outputs.get("canvas_width", 512)
         canvas_height = layer_outputs.get("canvas_height", 512)
         
-        # Create a standard empty black image for missing values
-        def create_empty_image(width, height):
-            empty_img = Image.new('RGB', (width, height), (0, 0, 0))
-            img_np = np.array(empty_img).astype(np.float32) / 255.0
-            return torch.from_numpy(img_np)[None, ]
-        
-        # Create a standard empty mask (white) for missing values
-        def create_empty_mask(width, height):
-            empty_mask = Image.new('L', (width, height), 255)  # White mask (completely transparent)
-            mask_np = np.array(empty_mask).astype(np.float32) / 255.0
-            return torch.from_numpy(mask_np)[None, ]
-        
-        # Ensure we have 8 images and masks
+        # Missing values are a black image and a white mask (completely transparent). Outputs are
+        # real tensors a consumer can write into: placeholder views of the compositor are materialized
+
+        # Ensure we have 8 images and masks, from slot first_layer - 1 on
+        first = first_layer - 1
         result_images = []
         result_masks = []
         
-        for i in range(8):
-            # Handle images
-            if i < len(images) and images[i] is not None:
-                result_images.append(images[i])
+        # with subtract_masks every layer above is needed, not only the eight unpacked
+        last = max(len(images), len(masks), first + 8) if subtract_masks else first + 8
+        for i in range(first, last):
+            # Handle images of the eight unpacked layers, compact (uint8) layers are turned back to float here
+            if i >= first + 8:
+                pass
+            elif i < len(images) and images[i] is not None:
+                result_images.append(expand_image(images[i]).contiguous())
             else:
-                result_images.append(create_empty_image(canvas_width, canvas_height))
+                result_images.append(torch.zeros((1, canvas_height, canvas_width, 3), dtype=torch.float32))
             
             # Handle masks
             if i < len(masks) and masks[i] is not None:
-                result_masks.append(masks[i])
+                result_masks.append(expand_mask(masks[i]).contiguous())
             else:
-                result_masks.append(create_empty_mask(canvas_width, canvas_height))
+                result_masks.append(torch.ones((1, canvas_height, canvas_width), dtype=torch.float32))
         
-        # Apply mask subtraction if enabled
+        # Apply mask subtraction if enabled, in one pass over all the layers
         if subtract_masks:
-            processed_masks = result_masks.copy()
-            
-            # We start from the second-highest mask (index 6, mask 7) and work down
-            # mask 8 (index 7) remains unchanged
-            for i in range(6, -1, -1):
-                current_mask = processed_masks[i]
-                higher_mask = processed_masks[i+1]
-                
-                # Where higher mask has black pixels (visible content), make current mask white (transparent)
-                # In mask convention: black (0) = visible, white (1) = transparent
-                black_pixels_in_higher = higher_mask < 0.5
-                
-                # Apply the subtraction - where higher mask has black pixels, make current mask white
-                processed_masks[i] = torch.where(black_pixels_in_higher, torch.ones_like(current_mask), current_mask)
-            
-            result_masks = processed_masks
+            result_masks = list(subtractMasks(result_masks).unbind(0))
         
         # Return all images and masks as a flat tuple
-        return (*result_images, *result_masks)
\ No newline at end of file
+        return (*result_images, *result_masks[:8])
\ No newline at end of file
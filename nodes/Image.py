@@ -1,8 +1,5 @@
-from PIL import Image
-import torch
-
 from nodes import MAX_RESOLUTION
-from ..common.imageFunctions import tensor2pil, pil2tensor
+from ..common.imageFunctions import resize_images
 
 class ImageScaleDown:
   crop_methods = ["disabled", "center"]
@@ -21,6 +18,12 @@ class ImageScaleDown:
           {"default": 512, "min": 1, "max": MAX_RESOLUTION, "step": 1},
         ),
         "crop": (s.crop_methods,),
+      },
+      "optional": {
+        "chunk_size": (
+          "INT",
+          {"default": 16, "min": 0, "max": 4096, "step": 1, "tooltip": "Frames resized at a time into the output, 0 resizes the whole batch at once"},
+        ),
       }
     }
 
@@ -28,7 +31,7 @@ class ImageScaleDown:
   CATEGORY = "Beyond nodes/Image"
   FUNCTION = "image_scale_down"
 
-  def image_scale_down(self, images, width, height, crop):
+  def image_scale_down(self, images, width, height, crop, chunk_size=16):
     if crop == "center":
       old_width = images.shape[2]
       old_height = images.shape[1]
@@ -44,13 +47,8 @@ class ImageScaleDown:
     else:
       s = images
 
-    results = []
-    for image in s:
-      img = tensor2pil(image).convert("RGB")
-      img = img.resize((width, height), Image.LANCZOS)
-      results.append(pil2tensor(img))
-
-    return (torch.cat(results, dim=0),)
+    # lanczos like PIL's LANCZOS, chunk by chunk into one preallocated output
+    return (resize_images(s[..., :3], width, height, "lanczos", chunk_size),)
 
 class ImageScaleDownBy(ImageScaleDown):
 
@@ -66,6 +64,12 @@ class ImageScaleDownBy(ImageScaleDown):
           "FLOAT",
           {"default": 0.5, "min": 0.01, "max": 1.0, "step": 0.01},
         ),
+      },
+      "optional": {
+        "chunk_size": (
+          "INT",
+          {"default": 16, "min": 0, "max": 4096, "step": 1, "tooltip": "Frames resized at a time into the output, 0 resizes the whole batch at once"},
+        ),
       }
     }
 
@@ -73,9 +77,9 @@ class ImageScaleDownBy(ImageScaleDown):
   CATEGORY = "Beyond nodes/Image"
   FUNCTION = "image_scale_down_by"
 
-  def image_scale_down_by(self, images, scale_by):
+  def image_scale_down_by(self, images, scale_by, chunk_size=16):
     width = images.shape[2]
     height = images.shape[1]
     new_width = int(width * scale_by)
     new_height = int(height * scale_by)
-    return self.image_scale_down(images, new_width, new_height, "center")
\ No newline at end of file
+    return self.image_scale_down(images, new_width, new_height, "center", chunk_size)
\ No newline at end of file
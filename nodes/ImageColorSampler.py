@@ -1,11 +1,11 @@
 import torch
 import numpy as np
-from PIL import Image
 import json
 import base64
 from io import BytesIO
 from server import PromptServer
 from comfy_execution.graph import ExecutionBlocker
+from ..common.imageFunctions import tensor2pil
 
 class ImageColorSampler:
     """
@@ -44,10 +44,7 @@ class ImageColorSampler:
     
     def tensor_to_base64_image(self, tensor):
         """Convert a torch tensor to a base64 encoded image string"""
-        # Convert tensor to numpy and then to PIL image
-        img_np = tensor.cpu().numpy().squeeze(0)
-        img_np = (img_np * 255).astype(np.uint8)
-        img_pil = Image.fromarray(img_np)
+        img_pil = tensor2pil(tensor)
         
         # Save to a bytes buffer and convert to base64
         buffered = BytesIO()
@@ -1,14 +1,15 @@
 import torch
-import numpy as np
-from PIL import Image, ImageSequence, ImageOps
+from PIL import Image, ImageSequence, ImageOps, ImageColor
 import os
 import folder_paths
 import comfy.utils
 import node_helpers
-import hashlib
-import torchvision.transforms.v2 as T
-from ..common.imageFunctions import tensor2pil, pil2tensor, image2mask, fit_resize_image, tensor_to_hash, create_temp_file
+import math
+import threading
+from collections import OrderedDict
+from ..common.imageFunctions import pil2tensor, image2mask, fit_resize_images, resize_images, tensor_fingerprint, create_temp_file
 from ..common import any
+from ..common.config import CONFIG
 
 
 # MASK RECT AREA ADVANCED
@@ -95,58 +96,30 @@ class ImageMaskScaleAs:
                             image=None, mask = None,
                             ):
         NODE_NAME = 'ImageMaskScaleAs'
-        if scale_as.shape[0] > 0:
-            _asimage = tensor2pil(scale_as[0])
+        # the target size comes from the shape: IMAGE [B,H,W,C], MASK [B,H,W] or [H,W]
+        if scale_as.dim() == 2:
+            target_height, target_width = scale_as.shape
         else:
-            _asimage = tensor2pil(scale_as)
-        target_width, target_height = _asimage.size
-        _mask = Image.new('L', size=_asimage.size, color='black')
-        _image = Image.new('RGB', size=_asimage.size, color='black')
+            target_height, target_width = scale_as.shape[1:3]
+        # PIL's BOX is the area filter of resize_images
+        resize_filter = "area" if method == "box" else method
         orig_width = 4
         orig_height = 4
-        resize_sampler = Image.LANCZOS
-        if method == "bicubic":
-            resize_sampler = Image.BICUBIC
-        elif method == "hamming":
-            resize_sampler = Image.HAMMING
-        elif method == "bilinear":
-            resize_sampler = Image.BILINEAR
-        elif method == "box":
-            resize_sampler = Image.BOX
-        elif method == "nearest":
-            resize_sampler = Image.NEAREST
-
-        ret_images = []
-        ret_masks = []
-        
+
+        ret_images = None
+        ret_masks = None
         if image is not None:
-            for i in image:
-                i = torch.unsqueeze(i, 0)
-                _image = tensor2pil(i).convert('RGB')
-                orig_width, orig_height = _image.size
-                _image = fit_resize_image(_image, target_width, target_height, fit, resize_sampler)
-                ret_images.append(pil2tensor(_image))
+            orig_height, orig_width = image.shape[1:3]
+            ret_images = fit_resize_images(image[..., :3], target_width, target_height, fit, resize_filter)
         if mask is not None:
             if mask.dim() == 2:
                 mask = torch.unsqueeze(mask, 0)
-            for m in mask:
-                m = torch.unsqueeze(m, 0)
-                _mask = tensor2pil(m).convert('L')
-                orig_width, orig_height = _mask.size
-                _mask = fit_resize_image(_mask, target_width, target_height, fit, resize_sampler).convert('L')
-                ret_masks.append(image2mask(_mask))
-        if len(ret_images) > 0 and len(ret_masks) >0:
-            # log(f"{NODE_NAME} Processed {len(ret_images)} image(s).", message_type='finish')
-            return (torch.cat(ret_images, dim=0), torch.cat(ret_masks, dim=0), [orig_width, orig_height],target_width, target_height,)
-        elif len(ret_images) > 0 and len(ret_masks) == 0:
-            # log(f"{NODE_NAME} Processed {len(ret_images)} image(s).", message_type='finish')
-            return (torch.cat(ret_images, dim=0), None, [orig_width, orig_height],target_width, target_height,)
-        elif len(ret_images) == 0 and len(ret_masks) > 0:
-            # log(f"{NODE_NAME} Processed {len(ret_masks)} image(s).", message_type='finish')
-            return (None, torch.cat(ret_masks, dim=0), [orig_width, orig_height], target_width, target_height,)
-        else:
+            orig_height, orig_width = mask.shape[1:3]
+            ret_masks = fit_resize_images(mask.unsqueeze(-1), target_width, target_height, fit, resize_filter).squeeze(-1)
+        if ret_images is None and ret_masks is None:
             # log(f"Error: {NODE_NAME} skipped, because the available image or mask is not found.", message_type='error')
             return (None, None, [orig_width, orig_height], 0, 0,)
+        return (ret_images, ret_masks, [orig_width, orig_height], target_width, target_height,)
 
 class MaskToImage:
     """Converts a mask (alpha) to an RGB image with a color and background"""
@@ -171,29 +144,82 @@ class MaskToImage:
     FUNCTION = "render_mask"
 
     def render_mask(self, mask, color, background, invert=False):
-        masks = tensor2pil(1.0 - mask) if invert else tensor2pil(mask)
-        images = []
-
-        for m in masks:
-            _mask = m.convert("L")
-
-            # log.debug(
-            #     f"Converted mask to PIL Image format, size: {_mask.size}"
-            # )
-
-            image = Image.new("RGBA", _mask.size, color=color)
-            # apply the mask
-            image = Image.composite(
-                image, Image.new("RGBA", _mask.size, color=background), _mask
-            )
-
-            # image = ImageChops.multiply(image, mask)
-            # apply over background
-            # image = Image.alpha_composite(Image.new("RGBA", image.size, color=background), image)
-
-            images.append(image.convert("RGB"))
-
-        return (pil2tensor(images),)
+        if mask.dim() == 2:
+            mask = mask.unsqueeze(0)
+        # colors are read like PIL reads them (css names, #rgb, #rrggbb(aa), rgb()), alpha ignored
+        color = torch.tensor(ImageColor.getrgb(color)[:3], dtype=torch.float32, device=mask.device) / 255.0
+        background = torch.tensor(ImageColor.getrgb(background)[:3], dtype=torch.float32, device=mask.device) / 255.0
+        if invert:
+            color, background = background, color
+
+        # one broadcasted lerp over the whole batch: background + mask * (color - background)
+        images = (mask.unsqueeze(-1).float() * (color - background)).add_(background)
+        return (images,)
+
+def gaussian_boxes(sigma, passes=3):
+    """Widths of passes box filters whose cascade has the variance of a gaussian of sigma (Kovesi's boxes for gauss)."""
+    ideal = math.sqrt(12.0 * sigma * sigma / passes + 1.0)
+    lower = int(math.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+    lower_count = round((12.0 * sigma * sigma - passes * lower * lower - 4 * passes * lower - 3 * passes) / (-4.0 * lower - 4.0))
+    return [lower if i < lower_count else upper for i in range(passes)]
+
+def box_blur_axis(x, radius, dim):
+    """Mean over 2*radius+1 samples along dim, edges replicated, as a difference of two prefix sums."""
+    if radius <= 0:
+        return x
+    length = x.shape[dim]
+    index = torch.arange(-radius - 1, length + radius, device=x.device).clamp(0, length - 1)
+    sums = x.index_select(dim, index).cumsum(dim)
+    window = 2 * radius + 1
+    return (sums.narrow(dim, window, length) - sums.narrow(dim, 0, length)).div_(window)
+
+# below it box widths are too coarse to follow the gaussian, and a direct kernel is short anyway
+BOX_BLUR_MIN_SIGMA = 3.0
+
+def gaussian_blur_axis(x, sigma, dim, radius=None):
+    """Direct gaussian over 3 sigma (or radius samples) along dim, edges replicated, for small sigmas."""
+    if radius is None:
+        radius = int(math.ceil(3.0 * sigma))
+    length = x.shape[dim]
+    offsets = torch.arange(-radius, radius + 1, device=x.device)
+    weights = torch.exp(-0.5 * (offsets.float() / sigma) ** 2)
+    weights /= weights.sum()
+    blurred = None
+    for offset, weight in zip(offsets.tolist(), weights.tolist()):
+        index = (torch.arange(length, device=x.device) + offset).clamp(0, length - 1)
+        tap = x.index_select(dim, index)
+        blurred = tap.mul_(weight) if blurred is None else blurred.add_(tap, alpha=weight)
+    return blurred
+
+def blur_mask(mask, sigma, passes=3, radius=None):
+    """
+    Gaussian blur of a mask [B,H,W] (or [H,W]). From BOX_BLUR_MIN_SIGMA on it is a cascade of separable box
+    filters, each a running sum, so the cost per pixel does not depend on sigma (float32 prefix sums keep the
+    error around 1e-4); smaller sigmas use a direct kernel of at most 19 taps, cut at radius when given.
+    """
+    if sigma <= 0:
+        return mask
+    blurred = mask.float()
+    if sigma < BOX_BLUR_MIN_SIGMA:
+        return gaussian_blur_axis(gaussian_blur_axis(blurred, sigma, -1, radius), sigma, -2, radius)
+    for width in gaussian_boxes(sigma, passes):
+        blurred = box_blur_axis(blurred, (width - 1) // 2, -1)
+        blurred = box_blur_axis(blurred, (width - 1) // 2, -2)
+    return blurred
+
+def mask_spans(flags):
+    """
+    Start and stop of the True entries along the last dim of flags [N, L], as two [N] tensors, and whether
+    there are any. Found with argmax on the flags and on their flip, so nothing per pixel is materialized.
+    """
+    length = flags.shape[-1]
+    found = flags.any(dim=-1)
+    start = flags.int().argmax(dim=-1)
+    stop = length - flags.flip(-1).int().argmax(dim=-1)
+    return start, stop, found
 
 class MaskBoundingBox:
     @classmethod
@@ -206,15 +232,16 @@ class MaskBoundingBox:
             },
             "optional": {
                 "image_optional": ("IMAGE",),
+                "per_frame": ("BOOLEAN", { "default": False, "tooltip": "One box per frame instead of one for the whole batch. Crops all get the size of the largest box, centered on each frame's box, so they stay one batch" }),
             }
         }
 
-    RETURN_TYPES = ("MASK", "IMAGE", "INT", "INT", "INT", "INT")
-    RETURN_NAMES = ("MASK", "IMAGE", "x", "y", "width", "height")
+    RETURN_TYPES = ("MASK", "IMAGE", "INT", "INT", "INT", "INT", "BBOX")
+    RETURN_NAMES = ("MASK", "IMAGE", "x", "y", "width", "height", "bboxes")
     FUNCTION = "execute"
     CATEGORY = "Beyond nodes/Masking"
 
-    def execute(self, mask, padding, blur, image_optional=None):
+    def execute(self, mask, padding, blur, image_optional=None, per_frame=False):
         if mask.dim() == 2:
             mask = mask.unsqueeze(0)
 
@@ -222,7 +249,7 @@ class MaskBoundingBox:
             image_optional = mask.unsqueeze(3).repeat(1, 1, 1, 3)
 
         # resize the image if it's not the same size as the mask
-        if image_optional.shape[1:] != mask.shape[1:]:
+        if image_optional.shape[1:3] != mask.shape[1:3]:
             image_optional = comfy.utils.common_upscale(image_optional.permute([0,3,1,2]), mask.shape[2], mask.shape[1], upscale_method='bicubic', crop='center').permute([0,2,3,1])
 
         # match batch size
@@ -231,23 +258,157 @@ class MaskBoundingBox:
         elif image_optional.shape[0] > mask.shape[0]:
             image_optional = image_optional[:mask.shape[0]]
 
-        # blur the mask
+        # boxes from row and column reductions: [B,H] and [B,W] flags, nothing of the mask's size is allocated
+        frames, height, width = mask.shape
+        # a line holds a nonzero value when its max or min is nonzero (same as |mask|.amax, without the |mask| copy)
+        rows = (mask.amax(dim=2) != 0) | (mask.amin(dim=2) != 0)
+        cols = (mask.amax(dim=1) != 0) | (mask.amin(dim=1) != 0)
+
+        # blur the mask, blur is the kernel size of a gaussian with torchvision's default sigma for it:
+        # the blurred mask reaches exactly spread = (blur - 1) // 2 pixels further, so the box grows by that much
+        spread = 0
         if blur > 0:
             if blur % 2 == 0:
                 blur += 1
-            mask = T.functional.gaussian_blur(mask.unsqueeze(1), blur).squeeze(1)
+            spread = (blur - 1) // 2
+            mask = blur_mask(mask, 0.3 * ((blur - 1) * 0.5 - 1) + 0.8, radius=spread)
+
+        if not per_frame:
+            rows = rows.any(dim=0, keepdim=True)
+            cols = cols.any(dim=0, keepdim=True)
+        y1, y2, found = mask_spans(rows)
+        x1, x2, _ = mask_spans(cols)
+        x1 = (x1 - spread - padding).clamp(min=0)
+        x2 = (x2 + spread + padding).clamp(max=width)
+        y1 = (y1 - spread - padding).clamp(min=0)
+        y2 = (y2 + spread + padding).clamp(max=height)
+
+        if not found.any():
+            print("[MaskBoundingBox] The mask is empty, keeping the whole frame")
+            x1, y1 = torch.zeros_like(x1), torch.zeros_like(y1)
+            x2, y2 = torch.full_like(x2, width), torch.full_like(y2, height)
+            found = torch.ones_like(found)
+
+        if not per_frame:
+            x1, y1, x2, y2 = int(x1[0]), int(y1[0]), int(x2[0]), int(y2[0])
+            # crop the mask
+            mask = mask[:, y1:y2, x1:x2]
+            image_optional = image_optional[:, y1:y2, x1:x2, :]
+            bboxes = [(x1, y1, x2 - x1, y2 - y1)] * frames
+            return (mask, image_optional, x1, y1, x2 - x1, y2 - y1, bboxes)
+
+        # every crop gets the size of the largest box, centered on its frame's box and kept inside the frame;
+        # a frame with an empty mask gets a crop at its center
+        crop_width = int((x2 - x1)[found].max())
+        crop_height = int((y2 - y1)[found].max())
+        center_x = torch.where(found, x1 + x2, torch.full_like(x1, width))
+        center_y = torch.where(found, y1 + y2, torch.full_like(y1, height))
+        left = ((center_x - crop_width) // 2).clamp(0, width - crop_width).tolist()
+        top = ((center_y - crop_height) // 2).clamp(0, height - crop_height).tolist()
+
+        mask = torch.stack([mask[i, y:y + crop_height, x:x + crop_width] for i, (x, y) in enumerate(zip(left, top))])
+        image_optional = torch.stack([image_optional[i, y:y + crop_height, x:x + crop_width] for i, (x, y) in enumerate(zip(left, top))])
+        bboxes = [(x, y, crop_width, crop_height) for x, y in zip(left, top)]
+        return (mask, image_optional, left[0], top[0], crop_width, crop_height, bboxes)
+
+class MaskPasteBack:
+    """Puts crops made with MaskBoundingBox, once processed, back into the full frames."""
 
-        _, y, x = torch.where(mask)
-        x1 = max(0, x.min().item() - padding)
-        x2 = min(mask.shape[2], x.max().item() + 1 + padding)
-        y1 = max(0, y.min().item() - padding)
-        y2 = min(mask.shape[1], y.max().item() + 1 + padding)
+    @classmethod
+    def INPUT_TYPES(s):
+        return {
+            "required": {
+                "image": ("IMAGE", { "tooltip": "The full frames the crops were taken from" }),
+                "crop": ("IMAGE", { "tooltip": "The processed crops, at the crop size or scaled (they are resized back to their box)" }),
+                "bboxes": ("BBOX", { "tooltip": "bboxes output of MaskBoundingBox" }),
+                "feather": ("INT", { "default": 16, "min": 0, "max": 512, "step": 1, "tooltip": "Width in pixels of the blend at the crop edges and mask edges" }),
+            },
+            "optional": {
+                "mask": ("MASK", { "tooltip": "Where the crop replaces the frame, in crop space (the MASK output of MaskBoundingBox); the whole crop without it" }),
+            }
+        }
 
-        # crop the mask
-        mask = mask[:, y1:y2, x1:x2]
-        image_optional = image_optional[:, y1:y2, x1:x2, :]
+    RETURN_TYPES = ("IMAGE",)
+    RETURN_NAMES = ("IMAGE",)
+    FUNCTION = "paste"
+    CATEGORY = "Beyond nodes/Masking"
 
-        return (mask, image_optional, x1, y1, x2 - x1, y2 - y1)
+    def paste(self, image, crop, bboxes, feather, mask=None):
+        frames, height, width = image.shape[:3]
+        if len(bboxes) == 1:
+            bboxes = list(bboxes) * frames
+        if mask is not None and mask.dim() == 2:
+            mask = mask.unsqueeze(0)
+        crop = crop[..., :3]
+        # the frames are copied once, all the work is on the crop regions
+        result = image.clone()
+
+        # boxes of the same size (all of them when they come from MaskBoundingBox) are resized and feathered together
+        groups = {}
+        for frame, (x, y, w, h) in enumerate(bboxes[:frames]):
+            groups.setdefault((int(w), int(h)), []).append(frame)
+        for (w, h), group in groups.items():
+            # like MaskBoundingBox, shorter crop and mask batches repeat their last frame
+            patches = crop[[min(frame, crop.shape[0] - 1) for frame in group]]
+            if patches.shape[1:3] != (h, w):
+                patches = resize_images(patches, w, h, "lanczos")
+            if mask is None:
+                weights = torch.ones((len(group), h, w), dtype=torch.float32, device=image.device)
+            else:
+                weights = mask[[min(frame, mask.shape[0] - 1) for frame in group]].float()
+                if weights.shape[1:3] != (h, w):
+                    weights = resize_images(weights.unsqueeze(-1), w, h, "bilinear").squeeze(-1)
+                weights = blur_mask(weights, feather / 3.0)
+
+            for patch, weight, frame in zip(patches, weights, group):
+                x, y = int(bboxes[frame][0]), int(bboxes[frame][1])
+                # fade out toward the box sides that are inside the frame, so no seam shows there
+                if feather > 0:
+                    ramp_x = torch.ones(w, device=weight.device)
+                    ramp_y = torch.ones(h, device=weight.device)
+                    fade = torch.arange(1, feather + 1, device=weight.device).float() / (feather + 1)
+                    if x > 0:
+                        ramp_x[:feather] = torch.minimum(ramp_x[:feather], fade[:w])
+                    if x + w < width:
+                        ramp_x[-feather:] = torch.minimum(ramp_x[-feather:], fade[:w].flip(0))
+                    if y > 0:
+                        ramp_y[:feather] = torch.minimum(ramp_y[:feather], fade[:h])
+                    if y + h < height:
+                        ramp_y[-feather:] = torch.minimum(ramp_y[-feather:], fade[:h].flip(0))
+                    weight = weight * ramp_y.unsqueeze(1) * ramp_x.unsqueeze(0)
+                region = result[frame, y:y + h, x:x + w]
+                region.lerp_(patch.to(region.dtype), weight.unsqueeze(-1).clamp(0.0, 1.0).to(region.dtype))
+
+        return (result,)
+
+class EditMaskCache:
+    """
+    The temp file written for an image fingerprint and the tensors decoded from a file version, shared by
+    the EditMask nodes: a least recently used dict of max_entries (BEYOND_NODES_EDIT_MASK_CACHE_ENTRIES).
+    Values are handed out as stored, so the decoded tensors are read-only: like any node output ComfyUI
+    serves from its cache, consumers must not write into them.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+editMaskCache = EditMaskCache(CONFIG["edit_mask_cache_entries"])
 
 class EditMask:
 
@@ -278,47 +439,43 @@ class EditMask:
 
     def edit(self, image,image_update=None):
 
-        # 根据image输入来判断是否是新的图片
-        if self.image_id==None:
-            self.image_id=tensor_to_hash(image)
+        # 根据image输入来判断是否是新的图片 (exact fingerprint, it also keys the caches below)
+        image_id=tensor_fingerprint(image)
+        if image_id!=self.image_id:
             image_update=None
-        else:
-            image_id=tensor_to_hash(image)
-            if image_id!=self.image_id:
-                image_update=None
-                self.image_id=image_id
+            self.image_id=image_id
 
 
         image_path=None
-        # print('#image_update',self.image_id,image_update)
-        if image_update==None:
-            print('--')
-        else:
-            if 'images' in image_update:
-                images=image_update['images']
-                filename=images[0]['filename']
-                subfolder=images[0]['subfolder']
-                type=images[0]['type']
-                name, base_dir=folder_paths.annotated_filepath(filename)
-                if type.endswith("output"):
-                    base_dir = folder_paths.get_output_directory() 
-                elif type.endswith("input"):
-                    base_dir = folder_paths.get_input_directory() 
-                elif type.endswith("temp"):
-                    base_dir = folder_paths.get_temp_directory() 
-                #base_dir = folder_paths.get_input_directory()  
-                # print(base_dir,subfolder, name)
-                image_path = os.path.join(base_dir,subfolder, name)
-        
-        if image_path==None:
-            image_path,images=create_temp_file(image)
-
-        print('#image_path',os.path.exists(image_path),image_path)
-        # image_path = folder_paths.get_annotated_filepath(image) #文件名
-        
-        if not os.path.exists(image_path):
-            image_path,images=create_temp_file(image)
-
+        if image_update is not None and 'images' in image_update:
+            images=image_update['images']
+            filename=images[0]['filename']
+            subfolder=images[0]['subfolder']
+            type=images[0]['type']
+            name, base_dir=folder_paths.annotated_filepath(filename)
+            if type.endswith("output"):
+                base_dir = folder_paths.get_output_directory() 
+            elif type.endswith("input"):
+                base_dir = folder_paths.get_input_directory() 
+            elif type.endswith("temp"):
+                base_dir = folder_paths.get_temp_directory() 
+            image_path = os.path.join(base_dir,subfolder, name)
+
+        if image_path is None or not os.path.exists(image_path):
+            # the temp file of an unchanged image is written once, not on every run
+            image_path, images = editMaskCache.get(("temp", image_id), (None, None))
+            if image_path is None or not os.path.exists(image_path):
+                image_path,images=create_temp_file(image)
+                editMaskCache.put(("temp", image_id), (image_path, images))
+
+        # files are decoded once per version (path, mtime and size)
+        stat = os.stat(image_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = editMaskCache.get(("decoded", image_path))
+        if cached is not None and cached[0] == version:
+            print('[EditMask] Unchanged image, reusing', image_path)
+            return {"ui":{"images": images},"result": cached[1]}
+        print('[EditMask] Decoding', image_path)
 
         img = node_helpers.pillow(Image.open, image_path)
         
@@ -342,11 +499,9 @@ class EditMask:
             if image.size[0] != w or image.size[1] != h:
                 continue
             
-            image = np.array(image).astype(np.float32) / 255.0
-            image = torch.from_numpy(image)[None,]
+            image = pil2tensor(image)
             if 'A' in i.getbands():
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                mask = 1. - torch.from_numpy(mask)
+                mask = 1. - image2mask(i.getchannel('A'))[0]
             else:
                 # 尺寸不对，需要按照image来
                 mask = torch.zeros((h, w), dtype=torch.float32, device="cpu")
@@ -361,6 +516,7 @@ class EditMask:
             output_image = output_images[0]
             output_mask = output_masks[0]
 
+        editMaskCache.put(("decoded", image_path), (version, (output_image, output_mask)))
         return {"ui":{"images": images},"result": (output_image, output_mask)}
 
         # return (output_image, output_mask)
@@ -8,6 +8,21 @@ const CANVAS_BORDER_COLOR = "#00b300b0";
 const COMPOSITION_BORDER_COLOR = "#00b300b0";
 const COMPOSITION_BORDER_SIZE = 2;
 const COMPOSITION_BACKGROUND_COLOR = "rgba(0,0,0,0.2)";
+// Canvas blend modes offered per layer (label shown in the layers panel), composed alike on the server
+const BLEND_MODES = {
+  "source-over": "N",
+  multiply: "Mul",
+  screen: "Scr",
+  overlay: "Ov",
+  darken: "Dk",
+  lighten: "Lt",
+  "color-dodge": "CD",
+  "color-burn": "CB",
+  "hard-light": "HL",
+  "soft-light": "SL",
+  difference: "Dif",
+  exclusion: "Exc",
+};
 const PADDING = 10;
 const HEIGHT = 512;
 const WIDTH = 512;
@@ -50,6 +65,9 @@ app.registerExtension({
 
   async setup(app) {
     api.addEventListener("compositor4_init", executedMessageHandler);
+    // compositor4_init only carries what changed since the last message to this client,
+    // after a page load nothing is on screen yet so ask for complete messages again
+    requestFullInit();
   },
 
   async nodeCreated(node) {
@@ -67,6 +85,7 @@ app.registerExtension({
       // Call the restoreCanvasState function which accesses widget values
       // and calls the editor's restoreState method
       restoreCanvasState(node);
+      requestFullInit(node.id);
     }
   },
 
@@ -79,6 +98,19 @@ function isCorrectType(node) {
   return node.constructor.comfyClass == COMPOSITOR_4;
 }
 
+// Ask the backend to send a complete compositor4_init next time, for one node or all of them
+function requestFullInit(nodeId) {
+  api
+    .fetchApi("/compositor4/resync", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ node_id: nodeId, client_id: api.clientId }),
+    })
+    .catch((error) => {
+      console.error("[Compositor4] resync request failed:", error);
+    });
+}
+
 function getWidget(node, widgetName) {
   return node.widgets.find((w) => w.name === widgetName);
 }
@@ -95,6 +127,10 @@ function getSeedWidget(node) {
   return getWidget(node, "seed");
 }
 
+function getDraftWidget(node) {
+  return getWidget(node, "draft");
+}
+
 const initializeCustomCanvasWidget = (node) => {
   if (isCorrectType(node)) {
     // Note: Widget hiding functionality is commented out as it doesn't work as expected
@@ -121,6 +157,7 @@ const initializeCustomCanvasWidget = (node) => {
       if (node.editor && node.editor.cleanup) {
         node.editor.cleanup();
       }
+      requestFullInit(node.id);
       if (originalOnRemoved) {
         originalOnRemoved.call(this);
       }
@@ -230,26 +267,30 @@ function executedMessageHandler(event, a, b) {
       editor.setSaveFolder(e.saveFolder);
     }
 
-    // Load images (this will clear old images and load new ones)
-    if (e.names && Array.isArray(e.names)) {
-      // console.log("[Compositor4] Loading images:", e.names);
-      e.names.forEach((name, index) => editor.appendImage(name, index));
-    }
+    // Only slots whose file or content hash changed since the last message are sent
+    const slots = Object.entries(e.slots || {}).map(([index, slot]) => [
+      Number(index),
+      slot,
+    ]);
+
+    // Load changed images (this replaces the old image in that slot)
+    slots.forEach(([index, slot]) => editor.appendImage(slot.name, index));
 
     // Store applyMaskInConfig mode
     if (e.applyMaskInConfig !== undefined) {
       editor.setApplyMaskInConfig(Boolean(e.applyMaskInConfig?.[0]));
     }
 
-    // Load mask filenames if available
-    if (e.maskNames && Array.isArray(e.maskNames)) {
-      editor.loadMasks(e.maskNames);
-    }
+    // Load changed mask filenames
+    slots.forEach(([index, slot]) => editor.loadMask(index, slot.maskName));
 
     // Handle auto-save for "grab and continue" mode
     const onConfigChangedContinue = Boolean(e.onConfigChangedContinue?.[0]);
     const configChanged = Boolean(e.configChanged?.[0]);
 
+    // In "wait in place" mode the backend is suspended until we post the snapshot
+    editor.setAwaitingSnapshot(Boolean(e.awaitingSnapshot?.[0]));
+
     console.log("[Compositor4] 3 Auto-save check:", {
       configChanged,
       onConfigChangedContinue,
@@ -270,12 +311,12 @@ function executedMessageHandler(event, a, b) {
       editor.updateSeedValue(e.configSignature);
     }
 
-    // If in "grab and continue" mode, auto-save and re-queue
+    // If in "grab and continue" mode, auto-save and re-queue (or resume the waiting prompt)
     if (configChanged && onConfigChangedContinue) {
       console.log("[Compositor4] Auto-save mode triggered");
 
       // In "grab and continue" mode: auto-save snapshot and re-queue
-      // Sequence: wait for images to load -> save -> wait -> enqueue
+      // Sequence: wait for images to load -> save -> wait -> enqueue or resume
       wait(100)
         .then(() => {
           console.log("[Compositor4] Starting auto-save");
@@ -283,8 +324,9 @@ function executedMessageHandler(event, a, b) {
         })
         .then(() => wait(100))
         .then(() => {
-          console.log("[Compositor4] Re-queueing workflow");
-          app.queuePrompt(0, 1);
+          console.log("[Compositor4] Continuing workflow");
+          // this finishes the run the user queued, so it renders full quality
+          return editor.continueExecution(false);
         })
         .catch((error) => {
           console.error("[Compositor4] Auto-save sequence failed:", error);
@@ -1054,7 +1096,8 @@ const Editor = (node, fabric) => {
   let snapEnabled = SNAP_ENABLED; // Editor property for snap to grid
   let gridSize = GRID_SIZE; // Editor property for grid size
   let backgroundColor = COMPOSITION_BACKGROUND_COLOR; // Background color for composition area
-  const IMAGE_COUNT = 9;
+  const IMAGE_COUNT = 9; // layers shown before any config arrives, grows with the connected layers
+  let layerCount = IMAGE_COUNT;
   let images = createNullArray(IMAGE_COUNT);
   let maskImages = createNullArray(IMAGE_COUNT); // Store Fabric mask image objects for clipPath
   let maskNames = createNullArray(IMAGE_COUNT); // Store mask filenames for each layer
@@ -1105,6 +1148,7 @@ const Editor = (node, fabric) => {
   let canvasHeight = HEIGHT;
   let canvasPadding = PADDING;
   let saveFolder = "output"; // Default folder for saving images
+  let awaitingSnapshot = false; // Backend waits in place for our next snapshot (resumeInPlace)
   let preciseSelection = false; // perPixelTargetFind for precise selection
 
   // Store keyboard handler reference for cleanup
@@ -1440,7 +1484,7 @@ const Editor = (node, fabric) => {
           activeObject.setCoords();
           fabricInstance.renderAll();
           saveAndUpdateSeed().then(() => {
-            api.enqueuePrompt(0, 1);
+            queueFromEditor();
           });
         }
       },
@@ -2034,6 +2078,10 @@ const Editor = (node, fabric) => {
     layerLockButtons[index] = lockButton; // Beyond
 
 
+    // Blend mode and opacity, also applied by the server-side composite
+    const blendButton = createBlendButton(index);
+    visibilityButton.parentNode.insertBefore(blendButton, visibilityButton);
+
     // Set initial lock button state Beyond
     if (lockButton) {
       const locked = isLockedLayer(index);
@@ -2044,6 +2092,63 @@ const Editor = (node, fabric) => {
     return layerItem;
   };
 
+  // Click cycles the canvas blend mode of the layer, the mouse wheel changes its opacity
+  const createBlendButton = (index) => {
+    const button = document.createElement("div");
+    applyStyles(button, {
+      width: "22px",
+      height: "20px",
+      flexShrink: "0",
+      display: "flex",
+      alignItems: "center",
+      justifyContent: "center",
+      fontSize: "9px",
+      color: COLOR_BUTTON_TEXT,
+      border: `1px solid ${COLOR_BUTTON_BORDER}`,
+      borderRadius: "3px",
+      cursor: "pointer",
+      userSelect: "none",
+    });
+
+    const refresh = () => {
+      const img = images[index];
+      const mode = img?.globalCompositeOperation || "source-over";
+      const opacity = img ? img.opacity ?? 1 : 1;
+      button.textContent = BLEND_MODES[mode] || "?";
+      button.title = `Blend: ${mode}, opacity ${Math.round(
+        opacity * 100
+      )}% (click: next blend mode, wheel: opacity)`;
+    };
+
+    button.onclick = (e) => {
+      e.stopPropagation();
+      const img = images[index];
+      if (!img) return;
+      const modes = Object.keys(BLEND_MODES);
+      const current = modes.indexOf(img.globalCompositeOperation || "source-over");
+      img.set({ globalCompositeOperation: modes[(current + 1) % modes.length] });
+      fabricInstance.renderAll();
+      refresh();
+      saveAndUpdateSeed();
+    };
+
+    button.onwheel = (e) => {
+      const img = images[index];
+      if (!img || img.visible === false) return;
+      e.preventDefault();
+      e.stopPropagation();
+      const step = e.deltaY < 0 ? 0.1 : -0.1;
+      const opacity = Math.min(1, Math.max(0.1, (img.opacity ?? 1) + step));
+      img.set({ opacity: Math.round(opacity * 10) / 10 });
+      fabricInstance.renderAll();
+      refresh();
+      saveAndUpdateSeed();
+    };
+
+    refresh();
+    return button;
+  };
+
   const createLayersPanelTitle = () => {
     const title = document.createElement("div");
     title.textContent = "Layers";
@@ -2429,6 +2534,42 @@ const Editor = (node, fabric) => {
     saveAndUpdateSeed();
   };
 
+  // Grow the per-layer arrays (and the layers panel) to hold count layers, new layers go on top
+  const ensureLayerCount = (count) => {
+    // restored state may also bring longer per-layer arrays than the current count
+    count = Math.max(
+      count,
+      layerCount,
+      imagePositions.length,
+      maskStates.length,
+      pendingTransforms.length
+    );
+    const grow = (array, fill) => {
+      while (array.length < count) {
+        array.push(fill(array.length));
+      }
+    };
+    [
+      images,
+      maskImages,
+      maskNames,
+      pendingTransforms,
+      layerItems,
+      layerThumbnails,
+      layerMaskThumbnails,
+      layerVisibilityButtons,
+      layerLockButtons,
+    ].forEach((array) => grow(array, () => null));
+    grow(maskStates, () => true);
+    grow(imagePositions, () => Math.max(-1, ...imagePositions) + 1);
+    if (count > layerCount) {
+      layerCount = count;
+      if (layersPanelEl) {
+        updateLayerPanelOrder();
+      }
+    }
+  };
+
   const swapLayerPositions = (fromIndex, toIndex) => {
     // Swap the positions in the imagePositions array
     const fromPosition = imagePositions[fromIndex];
@@ -2488,7 +2629,7 @@ const Editor = (node, fabric) => {
     });
 
     // update these icons whenever selection/order refreshes Beyond
-    for (let i = 0; i < IMAGE_COUNT; i++) {
+    for (let i = 0; i < layerCount; i++) {
       const item = layerItems[i];
       if (!item) continue;
 
@@ -2899,8 +3040,55 @@ const Editor = (node, fabric) => {
     const b = dataURLToBlob(dataURL);
     const result = await uploadImage(b, imageName);
     if (queue) {
-      app.queuePrompt(0, 1);
+      await continueExecution();
+    }
+  };
+
+  const setAwaitingSnapshot = (value) => {
+    awaitingSnapshot = value;
+  };
+
+  // Queue a prompt for the editor's own iterations, as a draft unless asked otherwise:
+  // the draft widget is only on while the prompt is built, so prompts the user queues render full quality
+  const queueFromEditor = async (draft = true) => {
+    const draftWidget = getDraftWidget(node);
+    if (!draft || !draftWidget) {
+      return app.queuePrompt(0, 1);
     }
+    draftWidget.value = true;
+    try {
+      await app.queuePrompt(0, 1);
+    } finally {
+      draftWidget.value = false;
+    }
+  };
+
+  // Resume the prompt waiting on this node if there is one, otherwise queue a new one
+  // (a draft, unless draft is false)
+  const continueExecution = async (draft = true) => {
+    if (awaitingSnapshot) {
+      awaitingSnapshot = false;
+      try {
+        const response = await api.fetchApi("/compositor/done", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({
+            node_id: node.id,
+            workflow_id: app.graph.id,
+            client_id: api.clientId,
+            imageName: imageNameWidget.value,
+            fabricData: fabricDataWidget.value,
+          }),
+        });
+        const result = await response.json();
+        if (result.resumed) {
+          return;
+        }
+      } catch (error) {
+        console.error("[Compositor4] resume failed, re-queueing:", error);
+      }
+    }
+    await queueFromEditor(draft);
   };
 
   const dataURLToBlob = (dataURL) => {
@@ -3053,6 +3241,7 @@ const Editor = (node, fabric) => {
     if (!imageSource) {
       return;
     }
+    ensureLayerCount(index + 1);
 
     let imageUrl;
     if (imageSource.startsWith("data:image/")) {
@@ -3104,6 +3293,7 @@ const Editor = (node, fabric) => {
       skewY: ref.skewY,
       skewX: ref.skewX,
       opacity: ref.opacity,
+      globalCompositeOperation: ref.globalCompositeOperation,
       visible: ref.visible,
       selectable: ref.selectable,
       evented: ref.evented,
@@ -3251,6 +3441,9 @@ const Editor = (node, fabric) => {
         pendingTransforms = data.transforms.slice(); // Copy the array
       }
 
+      // Saved compositions can hold more layers than the editor starts with
+      ensureLayerCount(data.transforms?.length || 0);
+
       // Restore images from imageNames if available
       if (data.imageNames && Array.isArray(data.imageNames)) {
         data.imageNames.forEach((imageName, index) => {
@@ -4207,33 +4400,51 @@ const Editor = (node, fabric) => {
     saveFolder = folder;
   };
 
+  const applyMaskName = async (index, maskName) => {
+    maskNames[index] = maskName;
+
+    // If in frontend clipPath mode and mask exists, load it as Fabric image
+    if (!applyMaskInConfig && maskName && images[index]) {
+      try {
+        await loadMaskAsClipPath(index);
+
+        // Apply clipPath if mask is enabled
+        if (maskStates[index]) {
+          images[index].set({ clipPath: maskImages[index] });
+          syncMaskWithImage(index);
+        }
+      } catch (error) {
+        console.error(`[Compositor4] Failed to load mask ${index}:`, error);
+      }
+    }
+
+    updateMaskThumbnail(index);
+  };
+
   const loadMasks = async (maskFilenames) => {
     // Load mask filenames and update layer panel previews
+    ensureLayerCount(maskFilenames.length);
     for (
       let index = 0;
-      index < maskFilenames.length && index < IMAGE_COUNT;
+      index < maskFilenames.length;
       index++
     ) {
-      const maskName = maskFilenames[index];
-      maskNames[index] = maskName;
-
-      // If in frontend clipPath mode and mask exists, load it as Fabric image
-      if (!applyMaskInConfig && maskName && images[index]) {
-        try {
-          await loadMaskAsClipPath(index);
+      await applyMaskName(index, maskFilenames[index]);
+    }
 
-          // Apply clipPath if mask is enabled
-          if (maskStates[index]) {
-            images[index].set({ clipPath: maskImages[index] });
-            syncMaskWithImage(index);
-          }
-        } catch (error) {
-          console.error(`[Compositor4] Failed to load mask ${index}:`, error);
-        }
-      }
+    if (fabricInstance) {
+      fabricInstance.renderAll();
+    }
+  };
 
-      updateMaskThumbnail(index);
+  const loadMask = async (index, maskName) => {
+    // Load a single mask filename and update its layer panel preview
+    if (maskName) {
+      ensureLayerCount(index + 1);
+    } else if (index >= layerCount) {
+      return;
     }
+    await applyMaskName(index, maskName);
 
     if (fabricInstance) {
       fabricInstance.renderAll();
@@ -4276,7 +4487,7 @@ const Editor = (node, fabric) => {
     console.log(`[Compositor4] applyMaskInConfig set to: ${applyMaskInConfig}`);
 
     // Update all mask thumbnails to reflect the mode
-    for (let i = 0; i < IMAGE_COUNT; i++) {
+    for (let i = 0; i < layerCount; i++) {
       updateMaskThumbnail(i);
     }
   };
@@ -4474,9 +4685,12 @@ const Editor = (node, fabric) => {
     setSaveFolder,
     setApplyMaskInConfig,
     loadMasks,
+    loadMask,
     restoreState,
     cleanup,
     queuedSave, // Expose for configuration change handling
+    setAwaitingSnapshot,
+    continueExecution, // Resume the waiting prompt or re-queue
     saveAndUpdateSeed,
     updateSeedValue, // Expose for auto-save with configSignature
     saveBtn,